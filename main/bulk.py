@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# bulk.py
+#
+# Bulk scan messages carry the task fields of many scans, a campaign of
+# URLs, in one message. Their tasks are saved with a few queries rather
+# than a few per scan, and the message is answered once all are finished.
+
+import threading
+
+# Frontend ids per query, within the 999 variables SQLite allows
+BULK_BATCH_SIZE = 500
+
+
+def chunks(values, size=BULK_BATCH_SIZE):
+    """
+    Yields consecutive slices of values of at most size items.
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def unique_scans(scans):
+    """
+    Returns scans with a single scan per frontend_id, the last one given,
+    in the order of their first occurrence. Tasks are unique.
+    """
+    last = {}
+    order = []
+    for scan in scans:
+        frontend_id = str(scan['frontend_id'])
+        if frontend_id not in last:
+            order.append(frontend_id)
+        last[frontend_id] = scan
+    return [last[x] for x in order]
+
+
+class BulkReply(object):
+    """
+    Status of the scans of a bulk message, by frontend_id, until the last
+    one finishes.
+    """
+
+    def __init__(self, frontend_ids):
+        self.results = dict((x, None) for x in frontend_ids)
+        self.left = len(self.results)
+        self.lock = threading.Lock()
+
+    def done(self, frontend_id, status):
+        """
+        Records the status of a scan, returns True when it was the last one
+        to finish.
+        """
+        with self.lock:
+            first = self.results[frontend_id] is None
+            self.results[frontend_id] = status
+            if first:
+                self.left -= 1
+            return first and self.left == 0
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# config.py
+#
+# Backend configuration, read from conf/backend.conf. run_thug and consumer
+# share the module level config: it is parsed once at import, reloaded on
+# SIGHUP, and its values are read where they are used so a reload applies
+# to the next task. The sizes of thread and container pools and the DNS
+# cache settings are only read at startup.
+
+import logging
+import os
+import signal
+import threading
+
+import ConfigParser
+import netifaces
+from django.conf import settings
+
+from main.utils import FILE_TRANSFER_INLINE, FILE_TRANSFER_STREAM
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = os.path.join(settings.BASE_DIR, "conf", "backend.conf")
+
+
+class Option(object):
+    """
+    An option of the config file: its type (str, int, float or bool), the
+    value used when it is missing or invalid, the smallest value allowed
+    and, for strings, the values allowed.
+    """
+
+    def __init__(self, name, type, default, minimum=None, choices=None):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.minimum = minimum
+        self.choices = choices
+
+    def parse(self, parser, section):
+        try:
+            if self.type is bool:
+                value = parser.getboolean(section, self.name)
+            elif self.type is int:
+                value = parser.getint(section, self.name)
+            elif self.type is float:
+                value = parser.getfloat(section, self.name)
+            else:
+                value = parser.get(section, self.name)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return self.default
+        except ValueError:
+            logger.warning("Invalid value for [{}] {}, using {!r}".format(
+                section, self.name, self.default))
+            return self.default
+
+        if self.minimum is not None:
+            value = max(self.minimum, value)
+        if self.choices is not None and value not in self.choices:
+            logger.warning("Invalid value for [{}] {}, using {!r}".format(
+                section, self.name, self.default))
+            return self.default
+        return value
+
+
+OPTIONS = {
+    'backend': [
+        # Host of the master backend, where the any queue is
+        Option('host', str, 'localhost'),
+        # The master backend declares the any queue
+        Option('is_master', bool, True),
+        # Seconds between Task table checks, in case a notification is lost
+        Option('poll_interval', int, 10, minimum=1),
+        # Unacked scan requests per queue, None for [thug] workers plus backlog
+        Option('prefetch', int, None, minimum=1),
+        # Scan requests accepted beyond [thug] workers, for run_thug to
+        # choose from by priority and fair share
+        Option('backlog', int, 0, minimum=0),
+        # x-max-priority of the queues this backend declares, 0 for none
+        Option('max_priority', int, 0, minimum=0),
+        Option('file_transfer', str, FILE_TRANSFER_INLINE,
+               choices=[FILE_TRANSFER_INLINE, FILE_TRANSFER_STREAM]),
+        # Bytes of file content in each streamed message
+        Option('chunk_size', int, 256 * 1024, minimum=1024),
+        # Hexdump binary files sent inline, else base64 encode them
+        Option('hexdump', bool, True),
+        # Reply with content hashes only
+        Option('dedupe', bool, False),
+        # Seconds a completed scan answers new tasks with the same URL and
+        # options, 0 always runs Thug
+        Option('result_cache', int, 0, minimum=0),
+        # Threads sending the replies of finished tasks
+        Option('reply_workers', int, 16, minimum=1),
+    ],
+    'thug': [
+        Option('use_sudo', bool, False),
+        Option('docker_image', str, 'thugsrumal/thug_docker'),
+        Option('docker_tag', str, 'latest'),
+        # Where Thug finds MongoDB, None for the host's docker0 address
+        Option('mongodb', str, None),
+        # Thug containers run concurrently
+        Option('workers', int, 1, minimum=1),
+        # Seconds after which a Thug run is killed, whatever its budget
+        Option('timeout', int, 10 * 60),
+        # Shortest budget of a Thug run, in seconds
+        Option('min_timeout', int, 60, minimum=1),
+        # Budget of tasks without an analysis timeout: this percentile of the
+        # recent scan durations times timeout_factor
+        Option('timeout_percentile', float, 99, minimum=1),
+        Option('timeout_factor', float, 2, minimum=1),
+        # Seconds a claimed task stays ours without a heartbeat
+        Option('lease', int, 60, minimum=3),
+        # Seconds between Task table polls when no notification arrives
+        Option('poll_interval', int, 10, minimum=1),
+        Option('dns_workers', int, 8, minimum=1),
+        # Seconds a flat tree waits for its DNS lookups
+        Option('dns_timeout', float, 5),
+        Option('dns_ttl', int, 5 * 60),
+        # Thug containers kept running to exec scans in, 0 for none
+        Option('warm_containers', int, 0, minimum=0),
+        # Scans after which a warm container is replaced
+        Option('recycle_after', int, 50, minimum=1),
+        # Bytes of the output of each Thug run kept on disk
+        Option('output_cap', int, 1024 * 1024, minimum=0),
+        # Seconds the outputs of failed tasks are kept, and bytes all of them
+        # may take; 0 for no limit
+        Option('output_max_age', int, 7 * 24 * 3600, minimum=0),
+        Option('output_total_cap', int, 1024 * 1024 * 1024, minimum=0),
+        # Seconds between looks for partial results of a scan, 0 for none
+        Option('progress_interval', int, 0, minimum=0),
+        # Scans running at once against a registered domain, 0 for no limit
+        Option('max_per_domain', int, 0, minimum=0),
+        # Scans running at once through a proxy, 0 for no limit
+        Option('max_per_proxy', int, 0, minimum=0),
+        # Share of the workers of each queue, as queue:weight pairs
+        Option('queue_weights', str, ''),
+    ],
+    'mongodb': [
+        Option('host', str, 'localhost'),
+        Option('port', int, 27017),
+        # Connections per process, None for twice [thug] workers plus 8
+        Option('max_pool_size', int, None, minimum=1),
+        # Seconds to wait for a pooled connection, 0 waits forever
+        Option('wait_queue_timeout', float, 30),
+        Option('connect_timeout', float, 10),
+        # Seconds a query may take, 0 for no limit
+        Option('socket_timeout', float, 120),
+        # Seconds to find a server for an operation, there is no unlimited
+        Option('server_selection_timeout', float, 30, minimum=1),
+        Option('read_preference', str, 'primary',
+               choices=['primary', 'primaryPreferred', 'secondary',
+                        'secondaryPreferred', 'nearest']),
+        # Write concern: acknowledging servers (or majority), journaled
+        Option('w', str, '1'),
+        Option('journal', bool, False),
+        # Create the missing indexes of the Thug collections at startup
+        Option('ensure_indexes', bool, True),
+    ],
+}
+
+
+class Section(object):
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def docker0_address():
+    return netifaces.ifaddresses('docker0')[netifaces.AF_INET][0]['addr']
+
+
+class BackendConfig(object):
+    """
+    Options are attributes of their section, e.g. config.thug.timeout.
+    Derived values (docker command line, image, MongoDB address) are
+    computed once per load.
+    """
+
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        parser = ConfigParser.ConfigParser()
+        parser.read(self.path)
+
+        sections = dict(
+            (section, Section((x.name, x.parse(parser, section)) for x in options))
+            for section, options in OPTIONS.items())
+        if sections['backend'].prefetch is None:
+            sections['backend'].prefetch = sections['thug'].workers + sections['backend'].backlog
+        if sections['mongodb'].max_pool_size is None:
+            sections['mongodb'].max_pool_size = 2 * sections['thug'].workers + 8
+
+        docker = ["/usr/bin/docker"]
+        if sections['thug'].use_sudo:
+            docker.insert(0, "/usr/bin/sudo")
+
+        queue_weights = {}
+        for pair in sections['thug'].queue_weights.split(','):
+            try:
+                queue, weight = pair.split(':')
+                queue_weights[queue.strip()] = max(0.01, float(weight))
+            except ValueError:
+                if pair.strip():
+                    logger.warning("Invalid queue weight {!r}".format(pair))
+
+        with self.lock:
+            self.backend = sections['backend']
+            self.thug = sections['thug']
+            self.mongodb = sections['mongodb']
+            self.docker = docker
+            self.queue_weights = queue_weights
+            self.image = "{}:{}".format(self.thug.docker_image, self.thug.docker_tag)
+            self._mongodb = self.thug.mongodb
+
+    def mongodb_address(self):
+        """
+        Returns the host:port Thug containers reach MongoDB at. Unless it is
+        configured, the host's docker0 address is looked up the first time.
+        """
+        with self.lock:
+            if self._mongodb is None:
+                self._mongodb = "{}:27017".format(docker0_address())
+            return self._mongodb
+
+    def reload(self, *args):
+        logger.info("Reloading {}".format(self.path))
+        try:
+            self.load()
+        except Exception as e:
+            logger.exception("Unable to reload {}: {}".format(self.path, e))
+
+    def reload_on_sighup(self):
+        """
+        Must be called from the main thread.
+        """
+        signal.signal(signal.SIGHUP, self.reload)
+
+
+config = BackendConfig()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# containers.py
+#
+# Pool of warm Thug containers. Starting a container for every URL costs
+# container creation, Python/V8 imports and teardown, often as much as a
+# simple scan. The pool keeps containers running idle and scans are run
+# in them with docker exec. A container is replaced after a number of
+# scans, or as soon as a scan in it fails or times out (removing it is
+# also the only way to stop a thug process started with docker exec).
+# Containers are labelled with the daemon owning them, so the ones left
+# behind by a daemon that died are removed by the next one.
+
+import errno
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to start a container when docker fails
+RETRY_DELAY = 10
+
+# Label of the warm containers, valued with the owner of their pool
+OWNER_LABEL = "rumal.owner"
+
+
+def owner_alive(owner):
+    """
+    Tells whether the daemon owner ("host:pid") may still be running.
+    Daemons of other hosts sharing the docker daemon are assumed to be.
+    """
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Container(object):
+
+    def __init__(self, container_id):
+        self.id = container_id
+        self.scans = 0
+
+
+class ContainerPool(object):
+    """
+    docker is the command line to invoke docker (e.g. with sudo), owner
+    identifies the daemon in the OWNER_LABEL of its containers. run is the
+    function running docker and returning its output and alive the one
+    telling whether an owner still runs, they can be replaced with fake
+    ones for tests.
+    """
+
+    def __init__(self, docker, image, size, recycle_after, owner,
+                 run=subprocess.check_output, alive=owner_alive):
+        self.docker = docker
+        self.image = image
+        self.size = size
+        self.recycle_after = recycle_after
+        self.owner = owner
+        self.run = run
+        self.alive = alive
+        self.idle = Queue.Queue()
+        self.busy = set()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Removes the containers of dead owners, then starts the containers in
+        background, acquire() waits for them.
+        """
+        self.remove_stale()
+        for _ in range(self.size):
+            self._replace(None)
+
+    def remove_stale(self):
+        """
+        Removes the labelled containers whose owner is not running anymore.
+        """
+        try:
+            listed = self.run(self.docker + [
+                "ps", "-a", "--filter", "label=" + OWNER_LABEL,
+                "--format", '{{.ID}} {{.Label "%s"}}' % OWNER_LABEL
+            ])
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error("Unable to list Thug containers: {}".format(e))
+            return
+
+        for line in listed.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] != self.owner and not self.alive(fields[1]):
+                logger.info("Removing container {} left by {}".format(fields[0], fields[1]))
+                self._remove(Container(fields[0]))
+
+    def acquire(self, timeout=None):
+        """
+        Returns an idle container, waiting up to timeout seconds for one if
+        none is ready. Returns None if none became ready.
+        """
+        try:
+            container = self.idle.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        with self.lock:
+            self.busy.add(container)
+        return container
+
+    def release(self, container, failed=False):
+        """
+        Gives back a container after a scan, replacing it if the scan failed
+        or the container ran recycle_after scans.
+        """
+        with self.lock:
+            self.busy.discard(container)
+            closed = self.closed
+        container.scans += 1
+        if closed:
+            self._remove(container)
+        elif failed or container.scans >= self.recycle_after:
+            logger.debug("Recycling container {} after {} scans{}".format(
+                container.id, container.scans, " (failed)" if failed else ""))
+            self._replace(container)
+        else:
+            self.idle.put(container)
+
+    def exec_args(self, container, args):
+        """
+        Returns the command line running args in container.
+        """
+        return self.docker + ["exec", "-e", "PYTHONUNBUFFERED=1", container.id] + args
+
+    def _replace(self, container):
+        replacement = threading.Thread(target=self._do_replace, args=(container,),
+                                       name="container-replacement")
+        replacement.daemon = True
+        replacement.start()
+
+    def _do_replace(self, container):
+        if container is not None:
+            self._remove(container)
+
+        while True:
+            try:
+                container_id = self.run(self.docker + [
+                    "run", "-d", "--rm",
+                    "--label", "{}={}".format(OWNER_LABEL, self.owner),
+                    "--entrypoint", "sleep",
+                    self.image, "infinity"
+                ]).strip()
+                break
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.error("Unable to start a Thug container: {}".format(e))
+                time.sleep(RETRY_DELAY)
+
+        logger.debug("Started container {}".format(container_id))
+        with self.lock:
+            closed = self.closed
+        if closed:
+            self._remove(Container(container_id))
+        else:
+            self.idle.put(Container(container_id))
+
+    def _remove(self, container):
+        try:
+            self.run(self.docker + ["rm", "-f", container.id])
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error("Unable to remove container {}: {}".format(container.id, e))
+
+    def shutdown(self):
+        """
+        Removes all the containers, the busy ones too: their scans end.
+        Containers still starting are removed once started.
+        """
+        with self.lock:
+            self.closed = True
+            containers = list(self.busy)
+            self.busy.clear()
+        while True:
+            try:
+                containers.append(self.idle.get_nowait())
+            except Queue.Empty:
+                break
+        for container in containers:
+            self._remove(container)
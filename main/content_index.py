@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# content_index.py
+#
+# Index of the SHA-256 of the (decoded) content of the files Thug stores in
+# GridFS. The same jQuery, ad network script or sample is stored again by
+# every analysis that meets it: the index lets the consumer send only hashes
+# and transfer a body just when the frontend does not already have it.
+
+import hashlib
+import logging
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+
+class ContentIndex(object):
+    """
+    collection keeps one {_id: file_id, sha256, size} document per file;
+    iter_file(file_id) must yield the decoded content of a file in chunks.
+    """
+
+    def __init__(self, collection, iter_file):
+        self.collection = collection
+        self.iter_file = iter_file
+
+    def ensure_indexes(self):
+        self.collection.create_index([("sha256", pymongo.ASCENDING)])
+
+    def digest(self, file_id):
+        """
+        Returns the (sha256, size) of the content of file_id, hashing it the
+        first time it is seen.
+        """
+        entry = self.collection.find_one({"_id": file_id})
+        if entry is not None:
+            return entry["sha256"], entry["size"]
+
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in self.iter_file(file_id):
+            sha256.update(chunk)
+            size += len(chunk)
+
+        entry = {"sha256": sha256.hexdigest(), "size": size}
+        self.collection.update_one({"_id": file_id}, {"$set": entry}, upsert=True)
+        logger.debug("Indexed file {} as {}".format(file_id, entry["sha256"]))
+        return entry["sha256"], entry["size"]
+
+    def find(self, sha256):
+        """
+        Returns the id of a file with the given content hash, None if unknown.
+        """
+        entry = self.collection.find_one({"sha256": sha256})
+        return entry["_id"] if entry is not None else None
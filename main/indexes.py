@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# indexes.py
+#
+# Indexes of the Thug collections the backend reads. Thug does not create
+# them, and without them every lookup of the documents of an analysis scans
+# the whole collection, getting slower as analyses accumulate. They are
+# created by the mongo_indexes command and when the daemons start.
+
+import logging
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from main.utils import CHILD_COLLECTIONS
+
+logger = logging.getLogger(__name__)
+
+ASC = pymongo.ASCENDING
+
+# Documents make_flat_tree groups by url
+URL_COLLECTIONS = ["locations", "samples", "exploits", "certificates"]
+
+
+def required_indexes():
+    """
+    Returns the (database, collection, keys) of the indexes the backend needs.
+    """
+    indexes = []
+    for name in CHILD_COLLECTIONS:
+        if name == "connections":
+            keys = [("analysis_id", ASC), ("chain_id", ASC)]
+        elif name in URL_COLLECTIONS:
+            keys = [("analysis_id", ASC), ("url_id", ASC)]
+        else:
+            keys = [("analysis_id", ASC)]
+        indexes.append(("thug", name, keys))
+
+    indexes.append(("thug", "analysiscombo", [("frontend_id", ASC)]))
+    indexes.append(("thugfs", "content_index", [("sha256", ASC)]))
+    return indexes
+
+
+def missing_indexes(client):
+    """
+    Returns the required indexes that do not exist.
+    """
+    missing = []
+    for database, collection, keys in required_indexes():
+        existing = [
+            [(field, int(direction) if isinstance(direction, float) else direction)
+             for field, direction in index["key"]]
+            for index in client[database][collection].index_information().values()]
+        # A compound index also serves the queries on its prefixes
+        if not any(index[:len(keys)] == keys for index in existing):
+            missing.append((database, collection, keys))
+    return missing
+
+
+def ensure_indexes(client):
+    """
+    Creates the missing indexes, in background so Thug can keep writing.
+    Returns the ones created.
+    """
+    missing = missing_indexes(client)
+    for database, collection, keys in missing:
+        logger.info("Creating index {} on {}.{}".format(keys, database, collection))
+        client[database][collection].create_index(keys, background=True)
+    return missing
+
+
+def ensure_indexes_on_startup(client):
+    """
+    ensure_indexes() for the daemons: a MongoDB that is not up yet must not
+    stop them.
+    """
+    try:
+        created = ensure_indexes(client)
+    except PyMongoError as e:
+        logger.error("Unable to create MongoDB indexes: {}".format(e))
+        return
+    if created:
+        logger.info("Created {} MongoDB indexes".format(len(created)))
+
+
+def set_profiling(client, slowms):
+    """
+    Makes MongoDB record the operations on the backend databases taking more
+    than slowms milliseconds, or none if slowms is None.
+    """
+    for database in set(x[0] for x in required_indexes()):
+        if slowms is None:
+            client[database].command("profile", 0)
+        else:
+            client[database].command("profile", 1, slowms=slowms)
+
+
+def _collection_scan(entry):
+    if "planSummary" in entry:
+        return entry["planSummary"].startswith("COLLSCAN")
+    # Profiles of older MongoDB versions only count what was examined
+    examined = entry.get("docsExamined", entry.get("nscannedObjects", 0))
+    keys = entry.get("keysExamined", entry.get("nscanned", 0))
+    return examined > 0 and keys == 0
+
+
+def unindexed_queries(client, limit=100):
+    """
+    Returns the profiled operations on the backend collections that scanned
+    a whole collection, most recent first in each database, as (namespace,
+    milliseconds, operation, query) tuples. Needs set_profiling() first.
+    """
+    namespaces = set("{}.{}".format(database, collection)
+                     for database, collection, keys in required_indexes())
+    namespaces.add("thug.urls")
+
+    queries = []
+    for database in set(x[0] for x in required_indexes()):
+        entries = client[database].system.profile.find({
+            "ns": {"$in": list(namespaces)}
+        }).sort("ts", pymongo.DESCENDING).limit(limit)
+        for entry in entries:
+            if _collection_scan(entry):
+                queries.append((entry["ns"], entry.get("millis"), entry.get("op"),
+                                entry.get("query", entry.get("command"))))
+    return queries
@@ -3,47 +3,177 @@ import pika
 import logging
 
 from django.core import serializers
+from django.db import connection
 from django.utils.encoding import smart_str
 
-import pymongo
 import gridfs
 import time
 
-from main.models import settings, Task
-from main.utils import DownloadError, Encoder, is_text, STATUS_COMPLETED, STATUS_NEW, STATUS_PROCESSING, STATUS_FAILED,\
-    NEW_SCAN_TASK, RPC_PORT, PRIVATE_QUEUE, PRIVATE_HOST, ANY_QUEUE
-
-from bson import json_util
+from main.config import config
+from main.content_index import ContentIndex
+from main.indexes import ensure_indexes_on_startup
+from main import metrics, payload
+from main.bulk import BulkReply, chunks, unique_scans
+from main.metrics import registry
+from main.models import Task, add_now
+from main.mongo import get_client
+from main.notify import Dispatcher, notify, start_listener
+from main.politeness import registered_domain
+from main.progress import PROGRESS_COLLECTIONS, Subscribers
+from main.result_cache import find_result, options_hash
+from main.throttle import Throttle
+from main.utils import DownloadError, is_text, STATUS_COMPLETED, STATUS_FAILED,\
+    NEW_SCAN_TASK, RPC_PORT, PRIVATE_QUEUE, PRIVATE_HOST, ANY_QUEUE, NEW_TASK_PORT, TASK_DONE_PORT,\
+    FILE_TRANSFER_STREAM, FILE_CHUNK, FETCH_FILES_TASK, BULK_SCAN_TASK, BULK_ITEM, PROGRESS, PROGRESS_PORT
+
+from bson import ObjectId, json_util
 import json
 import base64
 import magic
 import hexdump
 
-import ConfigParser
-import os
+import functools
 import threading
-import ast
-
-
-config = ConfigParser.ConfigParser()
-config.read(os.path.join(settings.BASE_DIR, "conf", "backend.conf"))
-BACKEND_HOST = config.get('backend', 'host', 'localhost')  # host of master backend where any queue is located
-try:
-    IS_BACKEND_MASTER = ast.literal_eval(config.get('backend', 'is_master', 'True'))  # master backend should define the any queue
-except ValueError:
-    IS_BACKEND_MASTER = True
 
 
 logger = logging.getLogger(__name__)
 
-client = pymongo.MongoClient()
+client = get_client()
 db = client.thug
 dbfs = client.thugfs
 fs = gridfs.GridFS(dbfs)
 
 
+class ChannelClosed(Exception):
+    pass
+
+
+class QueueConsumer(object):
+    """
+    Asynchronous consumer of one RPC queue. Keeps up to [backend] prefetch scan
+    requests unacked, each one acked when its reply is sent.
+    """
+
+    def __init__(self, command, host, port, queue_name):
+        self.command = command
+        self.host = host
+        self.port = port
+        self.queue_name = queue_name
+        self.connection = None
+        self.channel = None
+        self.consumer_tag = None
+
+    def run(self):
+        """
+        Connects and runs the IO loop, returns when the connection is closed.
+        :return:
+        """
+        parameters = pika.ConnectionParameters(host=self.host,
+                                               port=self.port
+                                               )
+        self.connection = pika.SelectConnection(parameters,
+                                                on_open_callback=self.on_connection_open,
+                                                on_open_error_callback=self.on_connection_error,
+                                                on_close_callback=self.on_connection_closed)
+        try:
+            self.connection.ioloop.start()
+        except KeyboardInterrupt:
+            self.connection.close()
+            self.connection.ioloop.start()  # until the connection is closed
+        except Exception as e:
+            logger.exception("Consumer of {} stopped: {}".format(self.queue_name, e))
+            if self.channel is not None:
+                self.command.throttle.remove(self)
+                self.channel = None
+            try:
+                if self.connection.is_open:
+                    self.connection.close()
+                    self.connection.ioloop.start()  # until the connection is closed
+            except Exception as e:
+                logger.debug("Unable to close connection to {}:{}: {}".format(self.host, self.port, e))
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        logger.debug("Cannot connect to RabbitMQ: {}".format(error))
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        logger.debug("Connection to {}:{} closed: {}".format(self.host, self.port, reply_text))
+        if self.channel is not None:
+            self.command.throttle.remove(self)
+            self.channel = None
+        connection.ioloop.stop()
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """
+        The broker closed the channel, e.g. on a queue declared with other
+        arguments or an ack of an unknown delivery. Closes the connection
+        too, so that run() returns and the consumer is restarted.
+        """
+        logger.warning("Channel of {} closed: ({}) {}".format(self.queue_name, reply_code, reply_text))
+        self.command.throttle.remove(self)
+        self.channel = None
+        self.consumer_tag = None
+        if self.connection.is_open:
+            self.connection.close()
+        elif not self.connection.is_closing:
+            self.connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self.on_channel_closed)
+        if config.backend.is_master or self.queue_name != ANY_QUEUE:
+            #  create any queue for master or create private queue.
+            arguments = None
+            if config.backend.max_priority:
+                # Higher priority requests are delivered first
+                arguments = {'x-max-priority': config.backend.max_priority}
+            channel.queue_declare(self.on_queue_declared, queue=self.queue_name, arguments=arguments)
+        else:
+            self.on_queue_declared(None)
+
+    def on_queue_declared(self, frame):
+        self.channel.basic_qos(self.on_qos_ok, prefetch_count=config.backend.prefetch)
+
+    def on_qos_ok(self, frame):
+        self.command.throttle.add(self)
+        logger.debug(" [x] Awaiting RPC requests in {} on {}:{}".format(self.queue_name, self.host, self.port))
+        if not self.command.throttle.full():
+            self.consume()
+
+    def consume(self):
+        if self.consumer_tag is None and self.channel is not None and self.channel.is_open:
+            self.consumer_tag = self.channel.basic_consume(self.command.on_request, queue=self.queue_name)
+
+    def cancel(self):
+        if self.consumer_tag is not None and self.channel is not None and self.channel.is_open:
+            self.channel.basic_cancel(consumer_tag=self.consumer_tag)
+        self.consumer_tag = None
+
+    def pause(self):
+        self.connection.add_callback_threadsafe(self.cancel)
+
+    def resume(self):
+        self.connection.add_callback_threadsafe(self.consume)
+
+
 class Command(BaseCommand):
 
+    # Callbacks of the tasks waiting for run_thug, by frontend_id
+    finished = Dispatcher("frontend_id", config.backend.reply_workers)
+
+    # Requests in flight on all the queues
+    throttle = Throttle(config.thug.workers + config.backend.backlog)
+
+    # Requests asking for the partial results of their scans
+    subscribers = Subscribers()
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.content_index = ContentIndex(dbfs.content_index, self.iter_file)
+
     def on_request(self, ch, method, props, body):
         """
         Process message based upon task field when message received
@@ -53,10 +183,54 @@ class Command(BaseCommand):
         :param body: message in queue
         :return:
         """
-        body = json.loads(body)
-        if int(body["task"]) == NEW_SCAN_TASK:  # new scan message
-            body.pop("task")
-            self.new_task(ch, method, props, body)
+        acquired = False
+        try:
+            body = json.loads(body)
+            if int(body["task"]) == NEW_SCAN_TASK:  # new scan message
+                body.pop("task")
+                self.throttle.acquire(ch)
+                acquired = True
+                self.new_task(ch, method, props, body)
+            elif int(body["task"]) == BULK_SCAN_TASK:  # many scans in one message
+                self.throttle.acquire(ch)
+                acquired = True
+                # Saving thousands of scans would hold up the connection thread
+                bulk = threading.Thread(target=self.new_bulk_task, args=(ch, method, props, body["scans"]))
+                bulk.daemon = True
+                bulk.start()
+            elif int(body["task"]) == FETCH_FILES_TASK:  # files by content hash
+                self.throttle.acquire(ch)
+                acquired = True
+                fetch = threading.Thread(target=self.fetch_files, args=(ch, method, props, body["hashes"]))
+                fetch.daemon = True
+                fetch.start()
+        except Exception as e:
+            # Raising would stop the IO loop of the connection
+            logger.exception("Unable to process request: {}".format(e))
+            self.reject(ch, method, props, body)
+            if acquired:
+                self.throttle.release(ch)
+
+    def reject(self, ch, method, props, body):
+        """
+        Answers a request that could not be processed with a failed status,
+        or drops it if there is no one to answer to. Either way it is not
+        delivered again, it would fail again.
+        :param ch: channel
+        :param method:
+        :param props: properties
+        :param body: message in queue, decoded or not
+        :return:
+        """
+        if props.reply_to:
+            frontend_id = body.get("frontend_id") if isinstance(body, dict) else None
+            data, properties = self.encode_reply(props, {"status": STATUS_FAILED,
+                                                         "data": frontend_id
+                                                         })
+            self.publish_item(ch, props.reply_to, data, properties)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
 
     def new_task(self, ch, method, props, body):
         """
@@ -73,100 +247,609 @@ class Command(BaseCommand):
         #  Tasks are unique. If they want to be rerun frontend needs to send them again.
         [x.delete() for x in Task.objects.filter(frontend_id=frontend_id)]
 
-        task_dict = [{"model": "main.task",
-                      "fields": body
-                      }]
-        task_dict = json.dumps(task_dict)
-        task_dict = smart_str(task_dict)
-        obj = serializers.deserialize('json', task_dict).next()
-        obj.save()
+        task = self.build_tasks(method, props, [body])[0]
+        task.save()
+
+        # Replying is done by the thread notified of the task completion,
+        # this one goes back to the channel. Tasks finishing before their
+        # callback is registered are found by check_finished.
+        self.finished.register(frontend_id, functools.partial(
+            self.task_finished, ch, method, props, frontend_id))
 
         logger.debug("Task saved {}".format(frontend_id))
+        if task.status == STATUS_COMPLETED:  # From the result cache
+            self.finished.fire(frontend_id)
+            return
+        self.subscribe(ch, props, frontend_id)
+        notify(NEW_TASK_PORT, {"task": task.id})
         logger.info("Waiting for task to finish {}".format(frontend_id))
 
-        # wait until scan is completed or failed.
-        while (Task.objects.get(frontend_id=frontend_id).status is STATUS_PROCESSING) or \
-                (Task.objects.get(frontend_id=frontend_id).status is STATUS_NEW):
-            time.sleep(2)
+    def new_bulk_task(self, ch, method, props, scans):
+        """
+        Processes a bulk task message: saves all its scans at once, replies
+        with a BULK_ITEM message for each scan as it finishes, then with the
+        status of every scan. Runs outside of the connection thread.
+        :param ch: channel
+        :param method:
+        :param props: callback queue
+        :param scans: task fields of each scan
+        :return:
+        """
+        #  Tasks are unique. If they want to be rerun frontend needs to send them again.
+        scans = unique_scans(scans)
+        frontend_ids = [str(x['frontend_id']) for x in scans]
+        logger.debug("Bulk task received with {} scans".format(len(frontend_ids)))
+        if not frontend_ids:
+            encoded = self.encode_reply(props, {"status": STATUS_COMPLETED, "results": {}})
+            self.threadsafe(ch, functools.partial(self.reply, ch, method, props, encoded))
+            return
 
-        # Task completed or failed
-        logger.debug("Task Completed {}".format(frontend_id))
+        try:
+            for ids in chunks(frontend_ids):
+                Task.objects.filter(frontend_id__in=ids).delete()
+            tasks = self.build_tasks(method, props, scans)
+            Task.objects.bulk_create(tasks)
+        except Exception as e:
+            logger.exception("Unable to save bulk task: {}".format(e))
+            encoded = self.encode_reply(props, {"status": STATUS_FAILED,
+                                                "results": dict((x, STATUS_FAILED) for x in frontend_ids)
+                                                })
+            self.threadsafe(ch, functools.partial(self.reply, ch, method, props, encoded))
+            return
+        finally:
+            connection.close()
 
-        task = Task.objects.get(frontend_id=frontend_id)
-        task_status = task.status
+        # Tasks finishing before their callback is registered are found
+        # by check_finished
+        bulk = BulkReply(frontend_ids)
+        for frontend_id in frontend_ids:
+            self.finished.register(frontend_id, functools.partial(
+                self.bulk_item_finished, ch, method, props, bulk, frontend_id))
+
+        logger.debug("Bulk task saved with {} scans".format(len(tasks)))
+        for task in tasks:
+            if task.status == STATUS_COMPLETED:  # From the result cache
+                self.finished.fire(str(task.frontend_id))
+            else:
+                self.subscribe(ch, props, str(task.frontend_id))
+        notify(NEW_TASK_PORT, {"tasks": len(tasks)})
+
+    def build_tasks(self, method, props, scans):
+        """
+        Returns the unsaved Task of each scan of a message. Scans found in
+        the result cache are completed already.
+        :param method:
+        :param props: properties of the message
+        :param scans: task fields of each scan
+        :return:
+        """
+        for body in scans:
+            # Scheduling, a priority in the message wins over the AMQP one
+            body['queue'] = method.routing_key
+            if body.get('priority') is None:
+                body['priority'] = props.priority or 0
 
-        if task_status == STATUS_COMPLETED:  # Successful scan
-            result = db.analysiscombo.find({'frontend_id': frontend_id})
-            files = self.generate_files(result[0])
+        task_dict = [{"model": "main.task",
+                      "fields": body
+                      } for body in scans]
+        task_dict = json.dumps(task_dict)
+        task_dict = smart_str(task_dict)
 
-            self.reply(ch, method, props, {"status": STATUS_COMPLETED,
-                                           "data": result[0],
-                                           "files": json_util.dumps(files)
-                                           })
+        tasks = []
+        for obj in serializers.deserialize('json', task_dict):
+            task = obj.object
+            task.domain = registered_domain(task.url)
+            task.options_hash = options_hash(task)
+            cached = None
+            if config.backend.result_cache:
+                cached = find_result(task, config.backend.result_cache, db.analysiscombo)
+                registry.inc('rumal_result_cache_total', result='hit' if cached else 'miss')
+            if cached:
+                logger.info("Task {} answered with cached analysis {}".format(task.frontend_id, cached))
+                task.status = STATUS_COMPLETED
+                task.object_id = cached
+                task.started_on = task.completed_on = add_now()
+            tasks.append(task)
+        return tasks
+
+    def task_finished(self, ch, method, props, frontend_id):
+        """
+        Sends the result of a completed or failed task. Runs outside of the
+        connection thread, so AMQP calls are handed back to it.
+        :param ch: channel
+        :param method:
+        :param props: callback queue
+        :param frontend_id: task frontend id
+        :return:
+        """
+        try:
+            task = Task.objects.get(frontend_id=frontend_id)
+            if task.status not in [STATUS_COMPLETED, STATUS_FAILED]:
+                # Notification about a previous run of the task, keep waiting
+                self.finished.register(frontend_id, functools.partial(
+                    self.task_finished, ch, method, props, frontend_id))
+                return
+            self.subscribers.remove(frontend_id)
+
+            logger.debug("Task Completed {}".format(frontend_id))
+            encoded = self.encode_reply(props, self.result(ch, props, task))
+        except DownloadError:
+            logger.debug("Something went wrong when downloading files")
+            # Leave the message to be delivered again
+            self.threadsafe(ch, functools.partial(self.requeue, ch, method))
+            return
+        except ChannelClosed:
+            logger.debug("Channel closed while streaming files of task {}".format(frontend_id))
+            return
+        except Exception as e:
+            # Reply anyway, an unanswered message holds its throttle slot
+            logger.exception("Unable to get the result of task {}: {}".format(frontend_id, e))
+            self.subscribers.remove(frontend_id)
+            encoded = self.encode_reply(props, {"status": STATUS_FAILED,
+                                                "data": frontend_id
+                                                })
+        finally:
+            connection.close()
 
-        if task_status == STATUS_FAILED:  # Failed scan
-            self.reply(ch, method, props, {"status": STATUS_FAILED,
-                                           "data": frontend_id
-                                           })
+        self.threadsafe(ch, functools.partial(self.reply, ch, method, props, encoded))
 
-        logger.debug("Response sent for task {}".format(frontend_id))
+        logger.debug("Response queued for task {}".format(frontend_id))
 
-    def generate_files(self, analysis):
-        data = []
+    def result(self, ch, props, task):
+        """
+        Returns the reply body for a completed or failed task
+        :param ch: channel
+        :param props: properties of the request
+        :param task: Task
+        :return:
+        """
+        frontend_id = str(task.frontend_id)
+
+        if task.status == STATUS_FAILED:  # Failed scan
+            return {"status": STATUS_FAILED,
+                    "data": frontend_id
+                    }
+
+        # Successful scan
+        analysis = self.find_analysis(task)
+        files = self.analysis_files(analysis)
+        with registry.time('rumal_phase_seconds', phase='files'):
+            if config.backend.dedupe:
+                files = self.hash_files(files)
+            elif config.backend.file_transfer == FILE_TRANSFER_STREAM:
+                files = self.stream_files(ch, props, files)
+            else:
+                files = self.inline_files(files)
+
+        return {"status": STATUS_COMPLETED,
+                "data": analysis,
+                "files": files,
+                "file_transfer": config.backend.file_transfer,
+                "dedupe": config.backend.dedupe
+                }
+
+    def bulk_item_finished(self, ch, method, props, bulk, frontend_id):
+        """
+        Sends the result of a scan of a bulk task as a BULK_ITEM message, and
+        the final reply after the last one.
+        :param ch: channel
+        :param method:
+        :param props: callback queue
+        :param bulk: BulkReply of the task
+        :param frontend_id: scan frontend id
+        :return:
+        """
+        try:
+            task = Task.objects.get(frontend_id=frontend_id)
+            if task.status not in [STATUS_COMPLETED, STATUS_FAILED]:
+                # Notification about a previous run of the task, keep waiting
+                self.finished.register(frontend_id, functools.partial(
+                    self.bulk_item_finished, ch, method, props, bulk, frontend_id))
+                return
+            self.subscribers.remove(frontend_id)
+
+            body = self.result(ch, props, task)
+        except DownloadError:
+            # Requeueing would scan the whole bulk again
+            logger.debug("Something went wrong when downloading files of task {}".format(frontend_id))
+            body = {"status": STATUS_FAILED,
+                    "data": frontend_id
+                    }
+        except ChannelClosed:
+            logger.debug("Channel closed while streaming files of task {}".format(frontend_id))
+            return
+        except Exception as e:
+            logger.exception("Unable to get the result of task {}: {}".format(frontend_id, e))
+            self.subscribers.remove(frontend_id)
+            body = {"status": STATUS_FAILED,
+                    "data": frontend_id
+                    }
+        finally:
+            connection.close()
+
+        try:
+            data, properties = self.encode_reply(props, body)
+        except Exception as e:
+            logger.exception("Unable to encode the result of task {}: {}".format(frontend_id, e))
+            body = {"status": STATUS_FAILED,
+                    "data": frontend_id
+                    }
+            data, properties = self.encode_reply(props, body)
+        properties.type = BULK_ITEM
+        properties.headers = {"frontend_id": frontend_id}
+        if not self.threadsafe(ch, functools.partial(self.publish_item, ch, props.reply_to, data, properties)):
+            return
+
+        if bulk.done(frontend_id, body["status"]):
+            logger.debug("Bulk task of {} scans finished".format(len(bulk.results)))
+            encoded = self.encode_reply(props, {"status": STATUS_COMPLETED,
+                                                "results": bulk.results})
+            self.threadsafe(ch, functools.partial(self.reply, ch, method, props, encoded))
+
+    def subscribe(self, ch, props, frontend_id):
+        """
+        Forwards the progress of the scan if the request names in its
+        progress_to header the routing key to send it to
+        :param ch: channel
+        :param props: properties of the request
+        :param frontend_id: task frontend id
+        :return:
+        """
+        if props.headers and props.headers.get('progress_to'):
+            self.subscribers.add(frontend_id, ch, props)
+
+    def forward_progress(self, message):
+        """
+        Sends the documents a running scan added, as notified by run_thug, in
+        a PROGRESS message to the progress_to routing key of its request
+        :param message: notification, as sent by progress.Watcher
+        :return:
+        """
+        frontend_id = message["frontend_id"]
+        request = self.subscribers.get(frontend_id)
+        if request is None or message["collection"] not in PROGRESS_COLLECTIONS:
+            return
+        ch, props = request
+
+        items = list(db[message["collection"]].find({
+            "_id": {"$in": [ObjectId(x) for x in message["ids"]]},
+            "analysis_id": ObjectId(message["analysis_id"])
+        }).sort("_id"))
+        body = {"frontend_id": frontend_id,
+                "analysis_id": message["analysis_id"],
+                "collection": message["collection"],
+                "items": items
+                }
+
+        data, properties = self.encode_reply(props, body)
+        properties.type = PROGRESS
+        properties.headers = {"frontend_id": frontend_id}
+        self.threadsafe(ch, functools.partial(
+            self.publish_item, ch, props.headers['progress_to'], data, properties))
+        registry.inc('rumal_progress_messages_total', collection=message["collection"])
+
+    def find_analysis(self, task):
+        """
+        Returns the analysiscombo document of a completed task. Tasks answered
+        from the result cache share the analysis of an earlier task.
+        :param task: Task
+        :return:
+        """
+        analysis = db.analysiscombo.find_one({'_id': ObjectId(task.object_id)})
+        analysis['frontend_id'] = str(task.frontend_id)
+        return analysis
+
+    def check_finished(self):
+        """
+        Fallback for lost notifications: looks up in the Task table the
+        tasks still waiting for a reply.
+        :return:
+        """
+        while True:
+            time.sleep(config.backend.poll_interval)
+            try:
+                # Bulk messages can leave more tasks pending than a query takes
+                for pending in chunks(self.finished.pending()):
+                    done = Task.objects.filter(
+                        frontend_id__in=pending,
+                        status__in=[STATUS_COMPLETED, STATUS_FAILED]
+                    ).values_list('frontend_id', flat=True)
+                    for frontend_id in done:
+                        if self.finished.fire(str(frontend_id)):
+                            logger.debug("Task {} found finished by polling".format(frontend_id))
+            except Exception as e:
+                logger.exception("Unable to check for finished tasks: {}".format(e))
+
+    def analysis_files(self, analysis):
+        """
+        Yields a (fields, file_id) tuple for each file stored in GridFS for the analysis,
+        fields identifies the file in the reply
+        :param analysis: analysiscombo document
+        :return:
+        """
         for x in analysis["locations"]:
             if x['content_id'] is not None:
-                data.append({"content_id": x['content_id'],
-                             "data": self.get_file(x['content_id'])
-                             })
+                yield {"content_id": x['content_id']}, x['content_id']
 
         for x in analysis["samples"]:
-            data.append({"sample_id": x['sample_id'],
-                         "data": self.get_file(x['sample_id'])
-                         })
+            yield {"sample_id": x['sample_id']}, x['sample_id']
 
         for x in analysis["pcaps"]:
             if x['content_id'] is not None:
-                data.append({"content_id": x["content_id"],
-                             "data": self.get_file(x['content_id'])
-                             })
+                yield {"content_id": x['content_id']}, x['content_id']
+
+    def inline_files(self, files):
+        """
+        Returns the files to be embedded in the reply
+        :param files: (fields, file_id) tuples, fields are copied in each entry
+        :return:
+        """
+        data = []
+        for fields, file_id in files:
+            content, encoding = self.get_file(file_id)
+            entry = dict(fields)
+            entry.update({"data": content,
+                          "encoding": encoding
+                          })
+            data.append(entry)
 
         return data
 
+    def hash_files(self, files):
+        """
+        Returns the content hash and size of the files instead of their content
+        :param files: (fields, file_id) tuples, fields are copied in each entry
+        :return:
+        """
+        data = []
+        for fields, file_id in files:
+            sha256, size = self.content_index.digest(file_id)
+            entry = dict(fields)
+            entry.update({"sha256": sha256,
+                          "size": size
+                          })
+            data.append(entry)
+
+        return data
+
+    def fetch_files(self, ch, method, props, hashes):
+        """
+        Replies with the files having the requested content hashes, the ones
+        the frontend did not have yet.
+        :param ch: channel
+        :param method:
+        :param props: callback queue
+        :param hashes: list of SHA-256 hex digests
+        :return:
+        """
+        try:
+            files = []
+            missing = []
+            for sha256 in hashes:
+                file_id = self.content_index.find(sha256)
+                if file_id is None:
+                    missing.append(sha256)
+                else:
+                    files.append(({"sha256": sha256}, file_id))
+
+            if config.backend.file_transfer == FILE_TRANSFER_STREAM:
+                files = self.stream_files(ch, props, files)
+            else:
+                files = self.inline_files(files)
+            encoded = self.encode_reply(props, {"status": STATUS_COMPLETED,
+                                                "files": files,
+                                                "missing": missing,
+                                                "file_transfer": config.backend.file_transfer
+                                                })
+        except DownloadError:
+            logger.debug("Something went wrong when downloading files")
+            self.threadsafe(ch, functools.partial(self.requeue, ch, method))
+            return
+        except ChannelClosed:
+            logger.debug("Channel closed while streaming files")
+            return
+        except Exception as e:
+            # Reply anyway, an unanswered message holds its throttle slot
+            logger.exception("Unable to fetch files: {}".format(e))
+            encoded = self.encode_reply(props, {"status": STATUS_FAILED})
+
+        self.threadsafe(ch, functools.partial(self.reply, ch, method, props, encoded))
+
     def get_file(self, file_id):
+        """
+        Returns the file content as unicode and how it was encoded: 'text',
+        'hexdump' or 'base64'
+        :param file_id: GridFS file id
+        :return:
+        """
         try:
-            download_file = base64.b64decode(fs.get(file_id).read())
+            encoded = fs.get(file_id).read()
+            download_file = base64.b64decode(encoded)
         except:
             raise DownloadError
 
-        hexdumped = False
+        encoding = 'text'
         mime = magic.from_buffer(download_file, mime=True)
         if not is_text(mime):
-            download_file = hexdump.hexdump(download_file, result='return')
-            hexdumped = True
+            if config.backend.hexdump:
+                download_file = hexdump.hexdump(download_file, result='return')
+                encoding = 'hexdump'
+            else:
+                # Files are stored base64 encoded, no need to convert them
+                download_file = encoded
+                encoding = 'base64'
 
         # Ensure to use Unicode for the content, else JsonResopnse may fail
         if not isinstance(download_file, unicode):
             download_file = unicode(download_file, errors='ignore')
 
-        return download_file
+        return download_file, encoding
 
-    def reply(self, ch, method, props, body):
+    def iter_file(self, file_id):
         """
-        Reply to callback queue with analysis result or failed status
-        :param ch:
-        :param method:
-        :param props:
-        :param body: message in reply
+        Yields the decoded content of a file [backend] chunk_size bytes at a time
+        :param file_id: GridFS file id
         :return:
         """
+        try:
+            grid_out = fs.get(file_id)
+        except:
+            raise DownloadError
 
+        # Files are stored base64 encoded: 4 characters for every 3 bytes
+        while True:
+            try:
+                chunk = base64.b64decode(grid_out.read(config.backend.chunk_size / 3 * 4))
+            except:
+                raise DownloadError
+            if not chunk:
+                break
+            yield chunk
+
+    def stream_files(self, ch, props, files):
+        """
+        Sends files to the callback queue as a sequence of raw binary messages
+        of type FILE_CHUNK, before the reply. Each message header carries the
+        file fields (e.g. its content_id), the chunk sequence number and
+        whether it is the last one. Returns the list of files sent.
+        :param ch: channel
+        :param props: properties of the request
+        :param files: (fields, file_id) tuples
+        :return:
+        """
+        sent = []
+        for fields, file_id in files:
+            mime = None
+            size = 0
+            seq = 0
+            chunks = self.iter_file(file_id)
+            chunk = next(chunks, '')
+            while True:
+                following = next(chunks, None)
+                if mime is None:
+                    mime = magic.from_buffer(chunk, mime=True)
+                headers = dict((k, str(v)) for k, v in fields.items())
+                headers.update({"seq": seq,
+                                "last": following is None,
+                                "mime": mime})
+                self.wait_threadsafe(ch, functools.partial(
+                    self.publish_chunk, ch, props, headers, chunk))
+                size += len(chunk)
+                seq += 1
+                if following is None:
+                    break
+                chunk = following
+
+            entry = dict(fields)
+            entry.update({"mime": mime,
+                          "size": size,
+                          "chunks": seq
+                          })
+            sent.append(entry)
+
+        return sent
+
+    def publish_chunk(self, ch, props, headers, chunk):
         ch.basic_publish(exchange='',
                          routing_key=props.reply_to,
                          properties=pika.BasicProperties(
-                             correlation_id=props.correlation_id),
-                         body=json.dumps(body, cls=Encoder))
+                             correlation_id=props.correlation_id,
+                             type=FILE_CHUNK,
+                             content_type='application/octet-stream',
+                             headers=headers),
+                         body=chunk)
+
+    def publish_item(self, ch, routing_key, data, properties):
+        with registry.time('rumal_phase_seconds', phase='reply'):
+            ch.basic_publish(exchange='',
+                             routing_key=routing_key,
+                             properties=properties,
+                             body=data)
+
+    def encode_reply(self, props, body):
+        """
+        Encodes the reply in the format negotiated with the request headers.
+        Plain JSON replies keep the files list JSON encoded in the files field.
+        :param props: properties of the request
+        :param body: message in reply
+        :return: reply data and properties
+        """
+        content_type, content_encoding = payload.negotiate(props.headers)
+        if content_type == payload.JSON and "files" in body:
+            body = dict(body, files=json_util.dumps(body["files"]))
+
+        properties = pika.BasicProperties(correlation_id=props.correlation_id,
+                                          content_type=content_type,
+                                          content_encoding=content_encoding)
+        with registry.time('rumal_phase_seconds', phase='encode'):
+            data = payload.encode(body, content_type, content_encoding)
+        return data, properties
+
+    def reply(self, ch, method, props, encoded):
+        """
+        Reply to callback queue with analysis result or failed status
+        :param ch:
+        :param method:
+        :param props:
+        :param encoded: message in reply, as returned by encode_reply
+        :return:
+        """
+        data, properties = encoded
+        with registry.time('rumal_phase_seconds', phase='reply'):
+            ch.basic_publish(exchange='',
+                             routing_key=props.reply_to,
+                             properties=properties,
+                             body=data)
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.throttle.release(ch)
+
+    def requeue(self, ch, method):
+        """
+        Gives the message back to the queue without replying
+        :param ch:
+        :param method:
+        :return:
+        """
+        ch.basic_nack(delivery_tag=method.delivery_tag)
+        self.throttle.release(ch)
+
+    def threadsafe(self, ch, callback):
+        """
+        Runs callback in the thread of the connection of ch
+        :param ch:
+        :param callback:
+        :return:
+        """
+        if not ch.is_open:
+            # The message was given back to the queue when the channel closed
+            logger.debug("Channel closed, dropping call to {}".format(
+                getattr(callback, 'func', callback).__name__))
+            return False
+        ch.connection.add_callback_threadsafe(callback)
+        return True
+
+    def wait_threadsafe(self, ch, callback):
+        """
+        Runs callback in the thread of the connection of ch and waits for it,
+        so that data is not read faster than it can be sent
+        :param ch:
+        :param callback:
+        :return:
+        """
+        done = threading.Event()
+
+        def run():
+            try:
+                callback()
+            finally:
+                done.set()
+
+        if not self.threadsafe(ch, run):
+            raise ChannelClosed
+        while not done.wait(1):
+            if not ch.is_open:
+                raise ChannelClosed
 
     def create_connection(self, host, port, queue_name):
         """
@@ -176,30 +859,7 @@ class Command(BaseCommand):
         :param queue_name: any_queue or private_queue
         :return:
         """
-        try:
-            parameters = pika.ConnectionParameters(host=host,
-                                                   port=port
-                                                   )
-            connection = pika.BlockingConnection(parameters)
-            channel = connection.channel()
-            if IS_BACKEND_MASTER or queue_name != ANY_QUEUE:
-                #  create any queue for master or create private queue.
-                channel.queue_declare(queue=queue_name)
-
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(self.on_request, queue=queue_name)
-
-            logger.debug(" [x] Awaiting RPC requests in {} on {}:{}".format(queue_name, host, port))
-            channel.start_consuming()
-
-        except DownloadError:
-            logger.debug("Something went wrong when downloading files")
-
-        except pika.exceptions.ConnectionClosed:
-            logger.debug("Cannot connect to RabbitMQ")
-
-        except KeyboardInterrupt:
-            connection.close()
+        QueueConsumer(self, host, port, queue_name).run()
 
     def handle(self, *args, **options):
         """
@@ -212,6 +872,23 @@ class Command(BaseCommand):
         any_queue = None
         private_queue = None
 
+        config.reload_on_sighup()
+
+        if config.mongodb.ensure_indexes:
+            ensure_indexes_on_startup(client)
+        elif config.backend.dedupe:
+            self.content_index.ensure_indexes()
+
+        registry.set('rumal_requests_in_flight', 0)
+        metrics.publish(metrics.process_name('consumer'))
+
+        # Completion notifications from run_thug, with polling as fallback
+        start_listener(TASK_DONE_PORT, self.finished)
+        start_listener(PROGRESS_PORT, self.forward_progress)
+        checker = threading.Thread(target=self.check_finished)
+        checker.daemon = True
+        checker.start()
+
         # Starting both queues, restarts them if they die
         while True:
 
@@ -224,7 +901,7 @@ class Command(BaseCommand):
 
                 any_queue = threading.Thread(
                     target=self.create_connection,
-                    kwargs={'host': BACKEND_HOST,
+                    kwargs={'host': config.backend.host,
                             'port': RPC_PORT,
                             'queue_name': ANY_QUEUE
                             }
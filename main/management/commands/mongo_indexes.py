@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# mongo_indexes.py
+#
+# Creates or checks the indexes of the Thug collections the backend reads,
+# and reports the profiled queries that are not covered by an index.
+#
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.indexes import ensure_indexes, missing_indexes, set_profiling, unindexed_queries
+from main.mongo import get_client
+
+
+class Command(BaseCommand):
+    help = "Creates the MongoDB indexes the backend needs and reports unindexed queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Only list the missing indexes, fail if there are any")
+        parser.add_argument('--profile', type=int, metavar='SLOWMS',
+                            help="Make MongoDB profile operations slower than SLOWMS "
+                                 "milliseconds, -1 stops profiling")
+        parser.add_argument('--report', action='store_true',
+                            help="List the profiled queries that scanned a whole collection")
+
+    def handle(self, *args, **options):
+        client = get_client()
+
+        if options['profile'] is not None:
+            if options['profile'] >= 0:
+                set_profiling(client, options['profile'])
+                self.stdout.write("Profiling operations slower than {}ms".format(options['profile']))
+            else:
+                set_profiling(client, None)
+                self.stdout.write("Profiling stopped")
+            if not options['report']:
+                return
+
+        if options['report']:
+            queries = unindexed_queries(client)
+            for namespace, millis, operation, query in queries:
+                self.stdout.write("{} {} {}ms {}".format(namespace, operation, millis, query))
+            if not queries:
+                self.stdout.write("No unindexed queries were profiled")
+            return
+
+        if options['check']:
+            missing = missing_indexes(client)
+            for database, collection, keys in missing:
+                self.stdout.write("Missing index {} on {}.{}".format(keys, database, collection))
+            if missing:
+                raise CommandError("{} indexes are missing".format(len(missing)))
+            self.stdout.write("All indexes exist")
+            return
+
+        created = ensure_indexes(client)
+        for database, collection, keys in created:
+            self.stdout.write("Created index {} on {}.{}".format(keys, database, collection))
+        if not created:
+            self.stdout.write("All indexes exist")
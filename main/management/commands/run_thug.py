@@ -20,54 +20,60 @@
 #           The Honeynet Project
 #
 import logging
-import netifaces
-import re
 import signal
 import subprocess
+import sys
+import threading
 import time
-import tldextract
 import socket
 import pytz
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from urlparse import urlparse
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+from django.db.models import Count, Min, Q
+from main import metrics
+from main.config import config
+from main.containers import ContainerPool
+from main.indexes import ensure_indexes_on_startup
+from main.metrics import registry
 from main.models import Task
-from main.utils import clone_without_object_ids, STATUS_PROCESSING, STATUS_FAILED, STATUS_NEW, STATUS_COMPLETED
-from socket import gaierror
+from main.mongo import get_client
+from main.notify import notify, start_listener
+from main.politeness import Limits
+from main.progress import Watcher
+from main.resolver import Resolver
+from main.scheduler import schedule
+from main.thug_output import ThugOutput, prune
+from main.timeouts import Durations
+from main.utils import clone_without_object_ids, STATUS_PROCESSING, STATUS_FAILED, STATUS_NEW, STATUS_COMPLETED,\
+    NEW_TASK_PORT, TASK_DONE_PORT, PROGRESS_PORT, CHILD_COLLECTIONS
 
-import pymongo
 from bson import ObjectId
-import ConfigParser
+import Queue
 import os
-import ast
 
 
-client = pymongo.MongoClient()
+client = get_client()
 db = client.thug
 
 logger = logging.getLogger(__name__)
 
-config = ConfigParser.ConfigParser()
-config.read(os.path.join(settings.BASE_DIR, "conf", "backend.conf"))
-
-# Reads Thug-related config
-# 1 - Use sudo when running Thug (default False)
-try:
-    USE_SUDO = ast.literal_eval(config.get('thug', 'use_sudo', 'False'))
-except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
-    USE_SUDO = False
-# 2 - Thug docker image to use (default thugsrumal/thug_docker)
-try:
-    THUG_DOCKER_IMAGE = config.get('thug', 'docker_image', 'thugsrumal/thug_docker')
-except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-    THUG_DOCKER_IMAGE = 'thugsrumal/thug_docker'
-# 3 - Thug docker image tag to use (default latest)
-try:
-    THUG_DOCKER_TAG = config.get('thug', 'docker_tag', 'latest')
-except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-    THUG_DOCKER_TAG = 'latest'
+# Output of the Thug runs, removed once the analysis is stored
+OUTPUT_DIR = os.path.join(settings.BASE_DIR, "logs", "thug")
+
+# Seconds between removals of the outputs kept too long
+OUTPUT_PRUNE_INTERVAL = 60 * 60
+
+# Identifies this daemon as the owner of the tasks it claims
+OWNER_ID = "{}:{}".format(socket.gethostname(), os.getpid())
+
+# Tries to store the outcome of a task, and seconds before the first retry,
+# doubled at each one. A task left running is reclaimed once its lease ends.
+RELEASE_ATTEMPTS = 5
+RELEASE_RETRY_DELAY = 1
 
 
 class TimeoutException(Exception):
@@ -78,44 +84,273 @@ class InvalidMongoIdException(Exception):
     pass
 
 
-def timeout_handler(signum, frame):
-    raise TimeoutException
+class WorkerPool(object):
+    """
+    Fixed number of threads, each one running a single task at a time.
+    The main loop asks for idle() before fetching tasks, so tasks are never
+    marked as running while they wait for a free worker. wakeup is set
+    whenever a worker becomes idle. held() lists the pks of the tasks
+    submitted and not finished, the ones whose leases are renewed.
+    """
+
+    def __init__(self, size, target, wakeup):
+        self.size = size
+        self.target = target
+        self.wakeup = wakeup
+        self.busy = 0
+        self.running = set()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        for i in range(size):
+            worker = threading.Thread(target=self._work,
+                                      name="thug-worker-{}".format(i))
+            worker.daemon = True
+            worker.start()
+
+    def idle(self):
+        with self.lock:
+            return self.size - self.busy
+
+    def held(self):
+        with self.lock:
+            return list(self.running)
+
+    def submit(self, task):
+        with self.lock:
+            self.busy += 1
+            self.running.add(task.pk)
+            registry.set('rumal_workers_busy', self.busy)
+        self.queue.put(task)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                self.target(task)
+            except Exception as e:
+                logger.exception(
+                    "[{}] Unhandled exception in worker: {}".format(task.id, e))
+            finally:
+                # Django keeps one DB connection per thread, don't leak them
+                connection.close()
+                with self.lock:
+                    self.busy -= 1
+                    self.running.discard(task.pk)
+                    registry.set('rumal_workers_busy', self.busy)
+                self.wakeup.set()
 
 
 class Command(BaseCommand):
 
-    def _fetch_new_tasks(self):
+    # Shared by all the tasks, so is its cache
+    resolver = Resolver(workers=config.thug.dns_workers,
+                        timeout=config.thug.dns_timeout,
+                        ttl=config.thug.dns_ttl)
+
+    # Warm Thug containers, if enabled
+    containers = None
+
+    # Recent scan durations, for the timeouts
+    durations = Durations()
+
+    def _fetch_new_tasks(self, count):
+        """
+        Returns up to count new tasks, chosen by priority and fair share
+        between queues and users (see main.scheduler), skipping the tasks of
+        domains and proxies already scanned by as many tasks as allowed.
+        """
+        new_tasks = Task.objects.filter(status__exact=STATUS_NEW)
+        waiting = dict(
+            ((x['priority'], x['user_id'], x['queue']), [x['count'], x['oldest']])
+            for x in new_tasks.values('priority', 'user_id', 'queue').annotate(
+                count=Count('id'), oldest=Min('submitted_on')))
+
+        processing = Task.objects.filter(status__exact=STATUS_PROCESSING)
+        running = dict(
+            ((x['user_id'], x['queue']), x['count'])
+            for x in processing.values('user_id', 'queue').annotate(count=Count('id')))
+        limits = Limits(config.thug.max_per_domain, config.thug.max_per_proxy,
+                        processing.values_list('domain', 'proxy_id'))
+
+        tasks = []
+        while count and waiting:
+            plan = schedule(
+                [key + tuple(value) for key, value in waiting.items()],
+                running, count, config.queue_weights)
+            for group, n in plan.items():
+                taken = self._take_tasks(new_tasks.filter(
+                    priority=group[0], user_id=group[1], queue=group[2]
+                ), n, limits, tasks)
+                count -= taken
+                running[group[1:]] = running.get(group[1:], 0) + taken
+                if taken < n:
+                    # Whatever is left waits for running scans to end,
+                    # other groups get the free workers
+                    del waiting[group]
+                else:
+                    waiting[group][0] -= taken
+                    if not waiting[group][0]:
+                        del waiting[group]
+
+        return sorted(tasks, key=lambda x: (-x.priority, x.submitted_on))
+
+    def _take_tasks(self, candidates, n, limits, tasks):
+        """
+        Appends to tasks up to n of candidates, oldest first, within limits.
+        Returns how many were taken.
+        """
+        taken = 0
+        while taken < n:
+            batch = list(candidates.exclude(
+                pk__in=[x.pk for x in tasks]
+            ).exclude(
+                domain__in=limits.full_domains()
+            ).exclude(
+                proxy_id__in=limits.full_proxies()
+            ).order_by('submitted_on')[:n - taken])
+            if not batch:
+                break
+            for task in batch:
+                # Tasks of the batch may fill up a domain or proxy
+                if limits.allows(task.domain, task.proxy_id):
+                    limits.add(task.domain, task.proxy_id)
+                    tasks.append(task)
+                    taken += 1
+        return taken
+
+    def _now(self):
+        return datetime.now(pytz.timezone(settings.TIME_ZONE))
+
+    def _reclaim_expired(self):
+        """
+        Puts back in STATUS_NEW the tasks whose owner stopped renewing their
+        lease (or that were claimed before leases existed).
+        """
         return Task.objects.filter(
-            status__exact=STATUS_NEW
-        ).order_by('submitted_on')
-
-    def _reset_processing(self):
-        Task.objects.filter(
+            Q(lease_expires_on__lt=self._now()) |
+            Q(lease_expires_on__isnull=True),
             status__exact=STATUS_PROCESSING
-        ).update(status=STATUS_NEW)
+        ).update(status=STATUS_NEW, owner=None, lease_expires_on=None)
+
+    def _renew_leases(self, pks):
+        """
+        Extends the leases of the tasks with the given pks, the ones our
+        workers are running. Tasks whose outcome could not be stored are not
+        among them, they expire and are reclaimed.
+        """
+        if not pks:
+            return 0
+        return Task.objects.filter(
+            pk__in=pks,
+            status__exact=STATUS_PROCESSING,
+            owner__exact=OWNER_ID
+        ).update(lease_expires_on=self._now() + timedelta(seconds=config.thug.lease))
+
+    def _heartbeat(self, pool):
+        while True:
+            time.sleep(config.thug.lease / 3.0)
+            try:
+                self._renew_leases(pool.held())
+            except Exception as e:
+                logger.exception("Unable to renew task leases: {}".format(e))
+
+    def _prune_output(self):
+        while True:
+            try:
+                removed = prune(OUTPUT_DIR, config.thug.output_max_age,
+                                config.thug.output_total_cap)
+                if removed:
+                    logger.info("Removed {} old Thug outputs".format(removed))
+            except Exception as e:
+                logger.exception("Unable to prune Thug outputs: {}".format(e))
+            time.sleep(OUTPUT_PRUNE_INTERVAL)
+
+    def _claim(self, task):
+        """
+        Atomically moves a task from STATUS_NEW to STATUS_PROCESSING.
+        Returns False if another daemon claimed it first.
+        """
+        now = self._now()
+        lease_expires_on = now + timedelta(seconds=config.thug.lease)
+        claimed = Task.objects.filter(
+            pk=task.pk,
+            status__exact=STATUS_NEW
+        ).update(status=STATUS_PROCESSING, owner=OWNER_ID, started_on=now,
+                 lease_expires_on=lease_expires_on)
+        if not claimed:
+            logger.debug("[{}] Task already claimed elsewhere".format(task.id))
+            return False
 
-    def _mark_as_running(self, task):
         logger.debug("[{}] Marking task as running".format(task.id))
-        task.started_on = datetime.now(pytz.timezone(settings.TIME_ZONE))
+        registry.observe('rumal_phase_seconds',
+                         (now - task.submitted_on).total_seconds(), phase='queued')
         task.status = STATUS_PROCESSING
-        task.save()
+        task.owner = OWNER_ID
+        task.started_on = now
+        task.lease_expires_on = lease_expires_on
+        return True
+
+    def _release(self, task, status):
+        """
+        Stores the outcome of a task, unless our lease on it was lost and
+        the task was handed over to someone else in the meantime.
+        """
+        task.completed_on = self._now()
+        task.status = status
+        for attempt in range(RELEASE_ATTEMPTS):
+            try:
+                released = self._store_outcome(task)
+                break
+            except DatabaseError as e:
+                # E.g. SQLite busy with other writers
+                if attempt == RELEASE_ATTEMPTS - 1:
+                    raise
+                logger.warning(
+                    "[{}] Unable to store task outcome, retrying: {}".format(task.id, e))
+                time.sleep(RELEASE_RETRY_DELAY * 2 ** attempt)
+        if not released:
+            logger.warning(
+                "[{}] Lease was lost, discarding result".format(task.id))
+            registry.inc('rumal_tasks_total', status='lost')
+            return
+
+        registry.inc('rumal_tasks_total',
+                     status='completed' if status == STATUS_COMPLETED else 'failed')
+
+        # Let the consumer reply without waiting for its next poll
+        notify(TASK_DONE_PORT, {"frontend_id": str(task.frontend_id),
+                                "status": status})
+
+    def _store_outcome(self, task):
+        return Task.objects.filter(
+            pk=task.pk,
+            status__exact=STATUS_PROCESSING,
+            owner__exact=OWNER_ID
+        ).update(status=task.status, completed_on=task.completed_on,
+                 object_id=task.object_id, lease_expires_on=None)
 
     def _mark_as_failed(self, task):
         logger.debug("[{}] Marking task as failed".format(task.id))
-        task.completed_on = datetime.now(pytz.timezone(settings.TIME_ZONE))
-        task.status = STATUS_FAILED
-        task.save()
+        self._release(task, STATUS_FAILED)
 
     def _mark_as_completed(self, task):
         logger.debug("[{}] Marking task as completed".format(task.id))
-        task.completed_on = datetime.now(pytz.timezone(settings.TIME_ZONE))
-        task.status = STATUS_COMPLETED
-        task.save()
-
-    def urlid_to_url(self, document):
-        document["url"] = db.urls.find_one({
-            "_id": ObjectId(document["url_id"])
-        })["url"]
+        self._release(task, STATUS_COMPLETED)
+
+    def find_urls(self, url_ids):
+        """
+        Fetches all the given urls with a single query.
+        Returns a dict mapping each url ObjectId to its document.
+        """
+        return dict(
+            (x["_id"], x)
+            for x in db.urls.find({
+                "_id": {"$in": list(set(ObjectId(x) for x in url_ids))}
+            }))
+
+    def urlid_to_url(self, document, urls):
+        document["url"] = urls[ObjectId(document["url_id"])]["url"]
         document.pop("url_id")
         return document
 
@@ -131,73 +366,61 @@ class Command(BaseCommand):
         return document
 
     def club_collections(self, analysis_id):
+        """
+        Merges all the documents Thug wrote for the analysis into a single
+        one. Takes one query per collection plus a single one for all the
+        referenced urls, whatever the size of the analysis.
+        """
         analysis = db.analyses.find_one({
             "_id": ObjectId(analysis_id)
         })
 
-        analysis["exploits"] = [
-            self.remove_id_analysis_id(self.urlid_to_url(x))
-            for x in db.exploits.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["codes"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.codes.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["behaviors"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.behaviors.find({
+        children = dict(
+            (name, list(db[name].find({
                 "analysis_id": ObjectId(analysis_id)
-            })]
+            })))
+            for name in CHILD_COLLECTIONS)
+
+        # All the urls referenced by the analysis, in one round trip
+        urls = self.find_urls(
+            [analysis["url_id"]] +
+            [x["url_id"] for x in children["exploits"]] +
+            [x["url_id"] for x in children["certificates"]] +
+            [x["source_id"] for x in children["connections"]] +
+            [x["destination_id"] for x in children["connections"]])
+
+        def url_map_entry(url_id):
+            entry = dict(urls[ObjectId(url_id)])
+            entry["old_id"] = entry.pop("_id")
+            return entry
+
+        analysis["exploits"] = [
+            self.remove_id_analysis_id(self.urlid_to_url(x, urls))
+            for x in children["exploits"]]
         analysis["certificates"] = [
-            self.remove_id_analysis_id(self.urlid_to_url(x))
-            for x in db.certificates.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["maec11"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.maec11.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["pcaps"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.pcaps.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
+            self.remove_id_analysis_id(self.urlid_to_url(x, urls))
+            for x in children["certificates"]]
 
-        first_url = db.urls.find_one({"_id": ObjectId(analysis["url_id"])})
-        first_url["old_id"] = first_url.pop("_id")
-        analysis["url_map"] = [first_url]  # for further grid_fs maps id to url
-        analysis = self.urlid_to_url(analysis)
+        # for further grid_fs maps id to url
+        analysis["url_map"] = [url_map_entry(analysis["url_id"])]
+        mapped = set([ObjectId(analysis["url_id"])])
+        analysis = self.urlid_to_url(analysis, urls)
         analysis.pop("_id")
 
         # Now cleaning connections
         # Using urls instead of url_ids
         connections = [
             self.remove_id_analysis_id(x)
-            for x in db.connections.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
+            for x in children["connections"]]
 
         for x in connections:
-            # x.pop("analysis_id")
-            # x.pop()
-            x["source_url"] = db.urls.find_one({
-                "_id": ObjectId(x["source_id"])
-            })["url"]
+            destination_id = ObjectId(x["destination_id"])
+            if destination_id not in mapped:
+                mapped.add(destination_id)
+                analysis["url_map"].append(url_map_entry(destination_id))
 
-            temp = db.urls.find_one({
-                "_id": ObjectId(x["destination_id"])
-            })
-
-            if temp not in analysis["url_map"]:
-                temp["old_id"] = temp.pop("_id")
-                analysis["url_map"].append(temp)
-
-            x["destination_url"] = temp["url"]
-            x.pop("source_id")
-            x.pop("destination_id")
+            x["source_url"] = urls[ObjectId(x.pop("source_id"))]["url"]
+            x["destination_url"] = urls[ObjectId(x.pop("destination_id"))]["url"]
 
         analysis["connections"] = connections
 
@@ -205,60 +428,58 @@ class Command(BaseCommand):
         # both id and analysis_id
         analysis["samples"] = [
             self.remove_analysis_id(x)
-            for x in db.samples.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["locations"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.locations.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["virustotal"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.virustotal.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["honeyagent"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.honeyagent.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["androguard"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.androguard.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
-        analysis["peepdf"] = [
-            self.remove_id_analysis_id(x)
-            for x in db.peepdf.find({
-                "analysis_id": ObjectId(analysis_id)
-            })]
+            for x in children["samples"]]
 
-        return analysis
-
-    def resolve_ip(self, url):
-        """ Resolves IP from given URL """
-        try:
-            ext = tldextract.extract(url)
-            if ext.subdomain:
-                # ToDo: possibly check for exceptions
-                return socket.gethostbyname(
-                    ext.subdomain + "." + ext.registered_domain
-                )
-            else:
-                return socket.gethostbyname(ext.registered_domain)
-        except gaierror:
-            return False
+        for name in CHILD_COLLECTIONS:
+            if name not in analysis:
+                analysis[name] = [
+                    self.remove_id_analysis_id(x)
+                    for x in children[name]]
 
+        return analysis
 
     def make_flat_tree(self, analysis, analysis_id):
         logger.info("Now making flat tree.")
 
-        root_url_id = db.connections.find({
+        # Everything the tree needs is loaded upfront, one query per
+        # collection, and grouped by url_id in memory
+        def by_url_id(collection):
+            grouped = {}
+            for x in db[collection].find({
+                "analysis_id": ObjectId(analysis_id)
+            }):
+                grouped.setdefault(x["url_id"], []).append(x)
+            return grouped
+
+        connections = list(db.connections.find({
             "analysis_id": ObjectId(analysis_id)
-        }).sort("chain_id")[0]['source_id']
+        }).sort("chain_id"))
+
+        urls = self.find_urls(
+            [x["source_id"] for x in connections] +
+            [x["destination_id"] for x in connections])
+
+        analysis["flat_tree"] = self.build_flat_tree(
+            connections,
+            urls,
+            by_url_id("locations"),
+            by_url_id("samples"),
+            by_url_id("exploits"),
+            by_url_id("certificates"))
+        return analysis
+
+    def build_flat_tree(self, connections, urls, locations, samples,
+                        exploits, certificates):
+        """
+        Builds the flat tree out of the connections of an analysis (sorted
+        by chain_id), the url documents by _id and the locations, samples,
+        exploits and certificates documents grouped by url_id.
+        """
+        root_url_id = connections[0]['source_id']
 
-        root_url = db.urls.find_one({"_id": root_url_id})
+        children = {}
+        for x in connections:
+            children.setdefault(x["source_id"], []).append(x["destination_id"])
 
         # flat_tree_nodes holds the tree in the form of a list
         # of nodes with each node having a node id(nid or index in list)
@@ -266,9 +487,9 @@ class Command(BaseCommand):
         # url_id is unique
         flat_tree_nodes = [{
             "url_id": root_url_id,
-            "parent": None,
-            "url": root_url
+            "parent": None
         }]  # root node as initial element
+        in_tree = set([root_url_id])
 
         # Traverses through flat_tree_nodes
         # initially consisting only of root
@@ -277,99 +498,74 @@ class Command(BaseCommand):
         # to parent are added.
         # Checks for cycles before adding
         for nid, node in enumerate(flat_tree_nodes):
-            url = db.urls.find_one({
-                "_id": ObjectId(node["url_id"])
-            })
-
-            locations = clone_without_object_ids(
-                db.locations.find_one({
-                    "analysis_id": ObjectId(analysis_id),
-                    "url_id": ObjectId(node["url_id"])
-                }) or {}
-            )
+            url_id = node["url_id"]
+            url = urls[url_id]
 
-            samples = [
+            node["url"] = url["url"]
+            node["domain"] = url and urlparse(url['url']).hostname or '-',
+            node["locations"] = clone_without_object_ids(
+                locations.get(url_id, [{}])[0])
+            node["samples"] = [
                 clone_without_object_ids(x, 'sample_id')
-                for x in db.sampless.find({
-                    "analysis_id": ObjectId(analysis_id),
-                    "url_id": ObjectId(node["url_id"])
-                })]
-
-            exploits = [
+                for x in samples.get(url_id, [])]
+            node["exploits"] = [
                 clone_without_object_ids(x)
-                for x in db.exploits.find({
-                    "analysis_id": ObjectId(analysis_id),
-                    "url_id": ObjectId(node["url_id"])
-                })]
-
-            certificates = [
+                for x in exploits.get(url_id, [])]
+            node["certificates"] = [
                 clone_without_object_ids(x)
-                for x in db.certificates.find({
-                    "analysis_id": ObjectId(analysis_id),
-                    "url_id": ObjectId(node["url_id"])
-                })]
-
-            node["url"] = url["url"]
-            node["domain"] = url and urlparse(url['url']).hostname or '-',
-            if node["url"] == 'about:blank':
-                node["ip"] = None
-            else:
-                url_ip = self.resolve_ip(node["url"])
-                if url_ip:
-                    node["ip"] = url_ip
-            node["locations"] = locations
-            node["samples"] = samples
-            node["exploits"] = exploits
-            node["certificates"] = certificates
+                for x in certificates.get(url_id, [])]
             node['nid'] = nid
-            flat_tree_nodes[nid] = node
-
-            for x in db.connections.find({
-                "analysis_id": ObjectId(analysis_id),
-                "source_id": ObjectId(node["url_id"])
-            }):
-                destination_id = x["destination_id"]
 
+            for destination_id in children.get(url_id, []):
                 # Checks for cycles
-                if destination_id in [n['url_id'] for n in flat_tree_nodes]:
+                if destination_id in in_tree:
                     continue  # Do not add node to tree
 
                 # No cycle found, add to tree
+                in_tree.add(destination_id)
                 flat_tree_nodes.append({
                     "url_id": destination_id,
                     "parent": nid
                 })
 
-        analysis["flat_tree"] = flat_tree_nodes
-        return analysis
+        # All hostnames of the tree are resolved at once
+        ips = self.resolver.resolve_urls(
+            node["url"] for node in flat_tree_nodes
+            if node["url"] != 'about:blank')
+        for node in flat_tree_nodes:
+            if node["url"] == 'about:blank':
+                node["ip"] = None
+            elif ips[node["url"]]:
+                node["ip"] = ips[node["url"]]
 
-    def run_task(self, task):
-        # Initialize args list for docker
-        args = [
-            "unbuffer",
-            "/usr/bin/docker", "run",
-            "--rm",
-            "-a", "stdin",
-            "-a", "stdout",
-            "-a", "stderr",
-            "-it",
-            THUG_DOCKER_IMAGE + ":" + THUG_DOCKER_TAG,
-            "thug",
-        ]
-
-        if USE_SUDO:
-            args.insert(1, "/usr/bin/sudo")
-
-        # Need to discover the host's docker0 IP address
-        # to be used to tell Thug where MongoDB resides
-        # FIXME: read this from a static config file before
-        # guessing.
+        return flat_tree_nodes
+
+    def _kill_process(self, task, process, expired, container_name):
+        logger.error(
+            "[{}] Execution was taking too long, killed".format(task.id))
+        expired.set()
+        # Killing the docker client alone leaves the container running
         try:
-            d0_address = netifaces.ifaddresses(
-                'docker0'
-            )[netifaces.AF_INET][0]['addr']
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(config.docker + ["kill", container_name],
+                                stdout=devnull, stderr=devnull)
+        except OSError as e:
+            logger.error("[{}] Unable to kill container {}: {}".format(
+                task.id, container_name, e))
+        try:
+            process.kill()
+        except OSError:
+            pass  # Already exited
+
+    def thug_args(self, task):
+        """
+        Returns the Thug command line for task.
+        """
+        args = ["thug"]
 
-            args.extend(['-D', '{}:27017'.format(d0_address)])
+        # Tell Thug where MongoDB resides
+        try:
+            args.extend(['-D', config.mongodb_address()])
         except:
             logger.critical("Unable to get docker0 address, aborting")
             raise
@@ -388,11 +584,11 @@ class Command(BaseCommand):
         if task.events:
             args.extend(['-e', task.events])
         if task.delay:
-            args.extend(['-w', task.delay])
+            args.extend(['-w', str(task.delay)])
         if task.timeout:
-            args.extend(['-T', task.timeout])
+            args.extend(['-T', str(task.timeout)])
         if task.threshold:
-            args.extend(['-t', task.threshold])
+            args.extend(['-t', str(task.threshold)])
         if task.no_cache:
             args.extend(['-m'])
         if task.extensive:
@@ -436,91 +632,219 @@ class Command(BaseCommand):
 
         # Add URL to args
         args.append(task.url)
+        return args
+
+    def run_task(self, task):
+        container = None
+        thug_args = self.thug_args(task)  # before acquiring, it may raise
+        if self.containers is not None:
+            # Exec Thug in a running container
+            container = self.containers.acquire(config.thug.timeout)
+            if container is None:
+                raise TimeoutException("No warm container became available")
+            args = self.containers.exec_args(container, thug_args)
+            container_name = container.id
+        else:
+            # Named, so it can be killed on timeout
+            container_name = "rumal-thug-{}-{}".format(os.getpid(), task.id)
+            # Initialize args list for docker
+            args = config.docker + [
+                "run",
+                "--rm",
+                "--name", container_name,
+                "-e", "PYTHONUNBUFFERED=1",
+                config.image,
+            ] + thug_args
 
         logger.debug(
             "[{}] Will run command: {}".format(task.id, " ".join(args)))
-        p = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-
-        # Set up a timeout of 10 minutes
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(10 * 60)
-
+        output = ThugOutput(
+            os.path.join(OUTPUT_DIR, "{}.log".format(task.id)),
+            config.thug.output_cap)
+        started = time.time()
         try:
-            stdout, stderr = p.communicate()
-            signal.alarm(0)  # reset the alarm
-        except TimeoutException:
-            logger.error(
-                "[{}] Execution was taking too long, killed".format(task.id))
+            p = subprocess.Popen(
+                args,
+                # Buffered, readline would read the output a byte at a time
+                bufsize=-1,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+        except:
+            if container is not None:
+                self.containers.release(container, failed=True)
             raise
 
-        r = re.search(r'\[MongoDB\] Analysis ID: ([a-z0-9]+)\b', stdout)
-        if r:
+        # Set up a timeout. SIGALRM can only be used by the main thread, so
+        # a timer thread kills the process and the output ends.
+        expired = threading.Event()
+        timeout = self.durations.budget(
+            task, config.thug.min_timeout, config.thug.timeout,
+            config.thug.timeout_percentile / 100.0, config.thug.timeout_factor)
+        registry.observe('rumal_timeout_budget_seconds', timeout)
+        logger.debug("[{}] Timeout set to {} seconds".format(task.id, timeout))
+        timer = threading.Timer(timeout, self._kill_process,
+                                [task, p, expired, container_name])
+        timer.start()
+
+        # Partial results for the frontend while Thug runs
+        watcher = None
+        if config.thug.progress_interval:
+            watcher = Watcher(db, task.frontend_id, output,
+                              config.thug.progress_interval, PROGRESS_PORT)
+            watcher.start()
+
+        try:
+            with registry.time('rumal_phase_seconds', phase='thug'):
+                try:
+                    output.read(p.stdout)
+                finally:
+                    p.stdout.close()
+                    p.wait()
+        finally:
+            timer.cancel()
+            if watcher is not None:
+                watcher.stop()
+            if container is not None:
+                # A killed docker exec leaves Thug running in the container
+                self.containers.release(
+                    container, failed=expired.is_set() or p.returncode != 0)
+
+        if output.first_line_at is not None:
+            registry.observe('rumal_phase_seconds',
+                             output.first_line_at - started, phase='docker_startup')
+
+        if expired.is_set():
+            raise TimeoutException(
+                "Execution took longer than {} seconds".format(timeout))
+
+        if output.analysis_id:
             logger.info(
-                "[{}] Got ObjectID: {}".format(task.id, r.group(1)))
-            analysis = self.club_collections(r.group(1))
-            analysis = self.make_flat_tree(analysis, r.group(1))
+                "[{}] Got ObjectID: {}".format(task.id, output.analysis_id))
+            with registry.time('rumal_phase_seconds', phase='club_collections'):
+                analysis = self.club_collections(output.analysis_id)
+            with registry.time('rumal_phase_seconds', phase='make_flat_tree'):
+                analysis = self.make_flat_tree(analysis, output.analysis_id)
             analysis["frontend_id"] = str(task.frontend_id)
-            final_id = db.analysiscombo.insert(analysis)
+            with registry.time('rumal_phase_seconds', phase='store'):
+                final_id = db.analysiscombo.insert(analysis)
+            output.discard()
             return final_id
         else:
             logger.error(
                 "[{}] Unable to get MongoDB analysis ID for the current "
-                "task".format(task.id))
+                "task, Thug output is in {}".format(task.id, output.path))
             raise InvalidMongoIdException(
                 "Unable to get MongoDB analysis ID for the current task")
 
+    def _process_task(self, task):
+        try:
+            task.object_id = self.run_task(task)
+        except subprocess.CalledProcessError as e:
+            logger.exception(
+                "[{}] Got CalledProcessError exception: {}".format(
+                    task.id, e))
+            self._mark_as_failed(task)
+            return
+        except TimeoutException as e:
+            logger.exception(
+                "[{}] Got Timeout exception: {}".format(
+                    task.id, e))
+            self._mark_as_failed(task)
+            return
+        except InvalidMongoIdException as e:
+            logger.exception(
+                "[{}] Got InvalidMongoIdException exception: {}".format(
+                    task.id, e))
+            self._mark_as_failed(task)
+            return
+        except Exception as e:
+            logger.exception(
+                "[{}] Got exception: {}".format(
+                    task.id, e))
+            self._mark_as_failed(task)
+            return
+
+        self._mark_as_completed(task)
+
     def handle(self, *args, **options):
         logger.info("Starting up run_thug daemon")
 
-        if USE_SUDO:
+        if config.thug.use_sudo:
             logger.info("Using SUDO")
         else:
             logger.info("Not using SUDO")
 
-        # Reset any tasks left behind from previous runs
-        logger.debug(
-            "Resetting any tasks left in STATUS_PROCESSING by previous runs")
-        self._reset_processing()
+        logger.info("Claiming tasks as {}".format(OWNER_ID))
+
+        try:
+            logger.info("Thug will use MongoDB at {}".format(config.mongodb_address()))
+        except Exception as e:
+            logger.critical("Unable to get docker0 address: {}".format(e))
+
+        config.reload_on_sighup()
+
+        if config.mongodb.ensure_indexes:
+            ensure_indexes_on_startup(client)
 
+        # Woken up by the consumer when a task is submitted and by workers
+        # when they finish; polling is kept as a fallback.
+        wakeup = threading.Event()
+        if start_listener(NEW_TASK_PORT, lambda message: wakeup.set()):
+            logger.info(
+                "Listening for new task notifications on port {}".format(NEW_TASK_PORT))
+
+        workers = config.thug.workers
+        logger.info("Starting {} Thug workers".format(workers))
+        pool = WorkerPool(workers, self._process_task, wakeup)
+
+        heartbeat = threading.Thread(target=self._heartbeat, args=(pool,), name="heartbeat")
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        pruner = threading.Thread(target=self._prune_output, name="output-pruner")
+        pruner.daemon = True
+        pruner.start()
+        registry.set('rumal_workers', workers)
+        registry.set('rumal_workers_busy', 0)
+        metrics.publish(metrics.process_name('run_thug'))
+
+        if config.thug.warm_containers:
+            logger.info("Starting {} warm Thug containers".format(
+                config.thug.warm_containers))
+            self.containers = ContainerPool(
+                config.docker, config.image,
+                config.thug.warm_containers, config.thug.recycle_after, OWNER_ID)
+            self.containers.start()
+            # Unwind on SIGTERM too, so that the containers are removed
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            self._dispatch(pool, wakeup)
+        finally:
+            if self.containers is not None:
+                self.containers.shutdown()
+
+    def _dispatch(self, pool, wakeup):
         # Start main thread
         while True:
-            logger.debug("Fetching new tasks")
-            tasks = self._fetch_new_tasks()
-            logger.debug("Got {} new tasks".format(len(tasks)))
-            for task in tasks:
-                self._mark_as_running(task)
-                try:
-                    task.object_id = self.run_task(task)
-                except subprocess.CalledProcessError as e:
-                    logger.exception(
-                        "[{}] Got CalledProcessError exception: {}".format(
-                            task.id, e))
-                    self._mark_as_failed(task)
-                    continue
-                except TimeoutException as e:
-                    logger.exception(
-                        "[{}] Got Timeout exception: {}".format(
-                            task.id, e))
-                    self._mark_as_failed(task)
-                    continue
-                except InvalidMongoIdException as e:
-                    logger.exception(
-                        "[{}] Got InvalidMongoIdException exception: {}".format(
-                            task.id, e))
-                    self._mark_as_failed(task)
-                    continue
-                except Exception as e:
-                    logger.exception(
-                        "[{}] Got exception: {}".format(
-                            task.id, e))
-                    self._mark_as_failed(task)
-                    continue
-
-                self._mark_as_completed(task)
-
-            logger.info("Sleeping for 10 seconds waiting for new tasks")
-            time.sleep(10)
+            # Reset any tasks left behind by dead daemons (including previous
+            # runs of this one)
+            reclaimed = self._reclaim_expired()
+            if reclaimed:
+                logger.info("Reclaimed {} expired tasks".format(reclaimed))
+
+            idle = pool.idle()
+            if idle:
+                logger.debug("Fetching up to {} new tasks".format(idle))
+                tasks = self._fetch_new_tasks(idle)
+                logger.debug("Got {} new tasks".format(len(tasks)))
+                for task in tasks:
+                    if self._claim(task):
+                        pool.submit(task)
+
+            logger.debug(
+                "Waiting up to {} seconds for new tasks".format(
+                    config.thug.poll_interval))
+            wakeup.wait(config.thug.poll_interval)
+            wakeup.clear()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# metrics.py
+#
+# Counters, gauges and latency histograms of the backend daemons.
+# run_thug and consumer run in their own processes, so each one
+# periodically writes a snapshot of its registry to METRICS_DIR and the
+# metrics view renders all the fresh snapshots in the Prometheus text
+# exposition format, labelled by process.
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# Snapshots older than this belong to dead processes
+STALE_AFTER = 5 * 60
+
+# Descriptions shown in the exposition
+HELP = {
+    'rumal_phase_seconds': 'Time spent by tasks in each processing phase.',
+    'rumal_tasks_total': 'Tasks processed by run_thug, by outcome.',
+    'rumal_workers': 'Thug worker threads.',
+    'rumal_workers_busy': 'Thug worker threads running a task.',
+    'rumal_requests_in_flight': 'Unacked RPC requests held by the consumer.',
+    'rumal_tasks': 'Tasks in the Task table, by status.',
+    'rumal_scan_duration_seconds': 'Quantiles of the recent scan durations, from the Task table.',
+    'rumal_timeout_budget_seconds': 'Seconds Thug runs were allowed to take.',
+    'rumal_result_cache_total': 'Scan requests answered from the result cache, or not.',
+    'rumal_progress_messages_total': 'Messages with partial results of running scans.',
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * len(DEFAULT_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        def entries(metrics):
+            return [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in metrics.items()]
+
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "counters": entries(self.counters),
+                "gauges": entries(self.gauges),
+                "histograms": entries(self.histograms),
+            }
+
+
+# One registry per process
+registry = Registry()
+
+
+def snapshot_path(process):
+    return os.path.join(settings.METRICS_DIR, "{}.json".format(process))
+
+
+def publish(process, interval=10):
+    """
+    Starts a thread writing a snapshot of the registry every interval
+    seconds, as process.
+    """
+    path = snapshot_path(process)
+
+    def write():
+        while True:
+            try:
+                if not os.path.isdir(settings.METRICS_DIR):
+                    os.makedirs(settings.METRICS_DIR)
+                tmp = path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(registry.snapshot(), f)
+                os.rename(tmp, path)  # readers never see partial files
+            except (IOError, OSError) as e:
+                logger.warning("Unable to write metrics to {}: {}".format(path, e))
+            time.sleep(interval)
+
+    writer = threading.Thread(target=write, name="metrics")
+    writer.daemon = True
+    writer.start()
+
+
+def process_name(command):
+    return "{}-{}-{}".format(command, socket.gethostname(), os.getpid())
+
+
+def load_snapshots():
+    """
+    Returns the fresh snapshots by process name, removing stale ones.
+    """
+    snapshots = {}
+    if not os.path.isdir(settings.METRICS_DIR):
+        return snapshots
+
+    for filename in os.listdir(settings.METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(settings.METRICS_DIR, filename)
+        try:
+            if os.path.getmtime(path) < time.time() - STALE_AFTER:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                snapshots[filename[:-len(".json")]] = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("Skipping metrics file {}: {}".format(path, e))
+    return snapshots
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+
+def render(snapshots, extra_gauges=None):
+    """
+    Renders snapshots and extra_gauges, a list of (name, labels, value)
+    tuples, in the Prometheus text exposition format.
+    """
+    samples = {}  # name -> (type, lines)
+
+    def add(name, metric_type, line):
+        samples.setdefault(name, (metric_type, []))[1].append(line)
+
+    for process, snapshot in sorted(snapshots.items()):
+        for entry in snapshot["counters"]:
+            labels = dict(entry["labels"], process=process)
+            add(entry["name"], "counter", "{}{} {}".format(entry["name"], _labels(labels), entry["value"]))
+        for entry in snapshot["gauges"]:
+            labels = dict(entry["labels"], process=process)
+            add(entry["name"], "gauge", "{}{} {}".format(entry["name"], _labels(labels), entry["value"]))
+        for entry in snapshot["histograms"]:
+            name = entry["name"]
+            histogram = entry["value"]
+            for bound, count in zip(DEFAULT_BUCKETS, histogram["buckets"]):
+                labels = dict(entry["labels"], process=process, le=bound)
+                add(name, "histogram", "{}_bucket{} {}".format(name, _labels(labels), count))
+            labels = dict(entry["labels"], process=process)
+            add(name, "histogram", "{}_bucket{} {}".format(name, _labels(dict(labels, le="+Inf")), histogram["count"]))
+            add(name, "histogram", "{}_sum{} {}".format(name, _labels(labels), histogram["sum"]))
+            add(name, "histogram", "{}_count{} {}".format(name, _labels(labels), histogram["count"]))
+
+    for name, labels, value in extra_gauges or []:
+        add(name, "gauge", "{}{} {}".format(name, _labels(labels), value))
+
+    lines = []
+    for name, (metric_type, metric_lines) in sorted(samples.items()):
+        if name in HELP:
+            lines.append("# HELP {} {}".format(name, HELP[name]))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        lines.extend(metric_lines)
+    return "\n".join(lines) + "\n"
@@ -57,11 +57,24 @@ class Task(models.Model):
     completed_on = models.DateTimeField("Completed on", null=True, blank=True, default=None)
     status = models.IntegerField("Status", null=False, blank=True, default=STATUS_NEW)
 
+    # Scheduling: higher priorities run first, the queue the task came from
+    priority = models.IntegerField("Priority", null=False, blank=True, default=0)
+    queue = models.CharField("Queue", null=True, blank=True, default=None, max_length=255)
+
+    # Lease held by the run_thug daemon processing the task
+    owner = models.CharField("Owner", null=True, blank=True, default=None, max_length=255)
+    lease_expires_on = models.DateTimeField("Lease expires on", null=True, blank=True, default=None)
+
     # ObjectID of Thug's analysis in MongoDB
     object_id = models.CharField("ObjectID", null=True, blank=True, default=None, max_length=24)
+    # Hash of the URL and options, tasks with the same one share results
+    options_hash = models.CharField("Options hash", null=True, blank=True, default=None, max_length=64,
+                                    db_index=True)
 
     # Base options
     url = models.CharField("Target URL", null=False, blank=False, max_length=4096)
+    # Registered domain of the URL, scans of a domain are limited
+    domain = models.CharField("Domain", null=True, blank=True, default=None, max_length=255, db_index=True)
     referer = models.CharField("Referer", null=True, blank=True, default=None, max_length=4096)
     useragent = models.CharField("User Agent", null=True, blank=True, default=None, max_length=50)
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#
+# mongo.py
+#
+# The MongoDB client of the process. run_thug workers, consumer replies
+# and the API all share one client and its connection pool, set up from
+# the [mongodb] section of the backend config. Like the other pool sizes
+# it is only read at startup.
+
+import threading
+
+import pymongo
+
+from main.config import config
+
+_client = None
+_lock = threading.Lock()
+
+
+def _ms(seconds):
+    return int(seconds * 1000) if seconds else None
+
+
+def client_options(options):
+    """
+    Returns the MongoClient keyword arguments for a [mongodb] config section.
+    """
+    w = int(options.w) if options.w.isdigit() else options.w
+    return {
+        "host": options.host,
+        "port": options.port,
+        "maxPoolSize": options.max_pool_size,
+        "waitQueueTimeoutMS": _ms(options.wait_queue_timeout),
+        "connectTimeoutMS": _ms(options.connect_timeout),
+        "socketTimeoutMS": _ms(options.socket_timeout),
+        "serverSelectionTimeoutMS": _ms(options.server_selection_timeout),
+        "readPreference": options.read_preference,
+        "w": w,
+        "j": options.journal,
+    }
+
+
+def get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            _client = pymongo.MongoClient(**client_options(config.mongodb))
+        return _client
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# notify.py
+#
+# Local notifications between the consumer and run_thug daemons.
+# Messages are small JSON datagrams sent on the loopback interface.
+# Delivery is best effort: a lost datagram only delays things until the
+# next database poll, which is kept as a fallback.
+
+import json
+import logging
+import Queue
+import socket
+import threading
+
+from main.utils import NOTIFY_HOST
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_SIZE = 65507
+
+
+def notify(port, message):
+    """
+    Sends message (a JSON serializable object) to whoever listens on port.
+    Never raises: nobody listening is not an error.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(json.dumps(message), (NOTIFY_HOST, port))
+    except socket.error as e:
+        logger.debug("Unable to send notification on port {}: {}".format(port, e))
+    finally:
+        sock.close()
+
+
+class Listener(threading.Thread):
+    """
+    Background thread calling callback(message) for every notification
+    received on port.
+    """
+
+    def __init__(self, port, callback):
+        super(Listener, self).__init__(name="listener-{}".format(port))
+        self.daemon = True
+        self.port = port
+        self.callback = callback
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # More daemons on the same host share the notifications
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((NOTIFY_HOST, port))
+
+    def run(self):
+        while True:
+            data = self.sock.recv(MAX_MESSAGE_SIZE)
+            try:
+                self.callback(json.loads(data))
+            except Exception as e:
+                logger.exception(
+                    "Error handling notification on port {}: {}".format(self.port, e))
+
+
+def start_listener(port, callback):
+    """
+    Starts a Listener, returns None if port cannot be bound so that callers
+    can fall back to polling.
+    """
+    try:
+        listener = Listener(port, callback)
+    except socket.error as e:
+        logger.warning(
+            "Unable to listen for notifications on port {}: {}".format(port, e))
+        return None
+
+    listener.start()
+    return listener
+
+
+class Dispatcher(object):
+    """
+    Routes notifications to the callbacks registered for the value they
+    carry in key. Each callback is called once, by one of workers threads,
+    so a slow callback does not hold back the others. A value can have more
+    callbacks, e.g. a scan submitted again while it runs: all are called.
+    """
+
+    def __init__(self, key, workers=8):
+        self.key = key
+        self.workers = workers
+        self.callbacks = {}
+        self.calls = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def register(self, value, callback):
+        with self.lock:
+            self.callbacks.setdefault(value, []).append(callback)
+
+    def pending(self):
+        with self.lock:
+            return self.callbacks.keys()
+
+    def fire(self, value, *args):
+        with self.lock:
+            callbacks = self.callbacks.pop(value, [])
+
+        for callback in callbacks:
+            self.calls.put((callback, args))
+        if callbacks:
+            self._start_workers()
+        return bool(callbacks)
+
+    def _start_workers(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                worker = threading.Thread(target=self._run,
+                                          name="dispatch-{}".format(len(self.threads)))
+                worker.daemon = True
+                worker.start()
+                self.threads.append(worker)
+
+    def _run(self):
+        while True:
+            callback, args = self.calls.get()
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception("Error in callback for {}: {}".format(self.key, e))
+
+    def __call__(self, message):
+        self.fire(message[self.key])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# payload.py
+#
+# Encoding of the RPC replies. The frontend lists in the 'accept' and
+# 'accept_encoding' headers of its request the formats it understands,
+# the reply says which ones were used in its content_type and
+# content_encoding properties. Plain JSON is used when nothing else is
+# accepted, so old frontends keep working.
+
+import json
+import zlib
+from datetime import datetime
+
+import bson
+from bson import ObjectId
+
+from main.utils import Encoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+BSON = 'application/bson'
+MSGPACK = 'application/x-msgpack'
+
+IDENTITY = None
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+# Favour speed, replies are compressed on every scan
+ZLIB_LEVEL = 1
+
+# Preferred first
+CONTENT_TYPES = [BSON] + ([MSGPACK] if msgpack else []) + [JSON]
+CONTENT_ENCODINGS = ([ZSTD] if zstandard else []) + [ZLIB]
+
+
+def _accepted(header):
+    if not header:
+        return []
+    if isinstance(header, (list, tuple)):
+        return list(header)
+    return [x.strip() for x in header.split(',')]
+
+
+def negotiate(headers):
+    """
+    Returns the (content_type, content_encoding) to use for a reply given the
+    headers of the request.
+    """
+    headers = headers or {}
+    accept = _accepted(headers.get('accept'))
+    accept_encoding = _accepted(headers.get('accept_encoding'))
+
+    content_type = next((x for x in CONTENT_TYPES if x in accept), JSON)
+    content_encoding = next((x for x in CONTENT_ENCODINGS if x in accept_encoding), IDENTITY)
+    return content_type, content_encoding
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Cannot serialize {!r}".format(obj))
+
+
+def _text(obj):
+    """
+    Python 2 str values are bytes to msgpack: the text ones are converted to
+    unicode, so that they are packed as msgpack str for the decoders of
+    other languages. Binary values stay bin.
+    """
+    if isinstance(obj, dict):
+        return dict((_text(k), _text(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_text(x) for x in obj]
+    if type(obj) is str:
+        try:
+            return obj.decode('utf-8')
+        except UnicodeDecodeError:
+            return obj
+    return obj
+
+
+def encode(body, content_type=JSON, content_encoding=IDENTITY):
+    if content_type == BSON:
+        data = bson.BSON.encode(body)
+    elif content_type == MSGPACK:
+        data = msgpack.packb(_text(body), default=_msgpack_default, use_bin_type=True)
+    else:
+        data = json.dumps(body, cls=Encoder)
+
+    if content_encoding == ZLIB:
+        data = zlib.compress(data, ZLIB_LEVEL)
+    elif content_encoding == ZSTD:
+        data = zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decode(data, content_type=JSON, content_encoding=IDENTITY):
+    if content_encoding == ZLIB:
+        data = zlib.decompress(data)
+    elif content_encoding == ZSTD:
+        data = zstandard.ZstdDecompressor().decompress(data)
+
+    if content_type == BSON:
+        return bson.BSON(data).decode()
+    if content_type == MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
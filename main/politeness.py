@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# politeness.py
+#
+# Limits on the scans running at the same time against a registered domain
+# and through a proxy, so a campaign of URLs on one site neither hammers it
+# nor gets our proxies blocked. Tasks of other domains and proxies are run
+# meanwhile.
+
+import urlparse
+
+import tldextract
+
+# The public suffix list snapshot shipped with tldextract, no download
+_extract = tldextract.TLDExtract(suffix_list_url=None)
+
+
+def registered_domain(url):
+    """
+    Returns the registered domain of url (e.g. example.co.uk), or its host
+    when it has no public suffix (IP addresses, intranet names). None for
+    URLs without a host, like about:blank.
+    """
+    parsed = urlparse.urlsplit(url.strip())
+    if not parsed.netloc:
+        if parsed.scheme and '.' not in parsed.scheme:
+            return None
+        # Thug accepts URLs without a scheme
+        parsed = urlparse.urlsplit('//' + url.strip())
+    if not parsed.hostname:
+        return None
+
+    parts = _extract(parsed.hostname)
+    if not parts.domain:
+        return None
+    if not parts.suffix:
+        return parts.domain.lower()
+    return "{}.{}".format(parts.domain, parts.suffix).lower()
+
+
+class Limits(object):
+    """
+    Counts the running scans by domain and proxy. A limit of 0 disables it.
+    running lists the (domain, proxy_id) of the tasks running.
+    """
+
+    def __init__(self, max_per_domain, max_per_proxy, running=()):
+        self.max_per_domain = max_per_domain
+        self.max_per_proxy = max_per_proxy
+        self.domains = {}
+        self.proxies = {}
+        for domain, proxy_id in running:
+            self.add(domain, proxy_id)
+
+    def add(self, domain, proxy_id):
+        if domain is not None:
+            self.domains[domain] = self.domains.get(domain, 0) + 1
+        if proxy_id is not None:
+            self.proxies[proxy_id] = self.proxies.get(proxy_id, 0) + 1
+
+    def allows(self, domain, proxy_id):
+        if self.max_per_domain and domain is not None and \
+                self.domains.get(domain, 0) >= self.max_per_domain:
+            return False
+        if self.max_per_proxy and proxy_id is not None and \
+                self.proxies.get(proxy_id, 0) >= self.max_per_proxy:
+            return False
+        return True
+
+    def full_domains(self):
+        if not self.max_per_domain:
+            return []
+        return [x for x, count in self.domains.items() if count >= self.max_per_domain]
+
+    def full_proxies(self):
+        if not self.max_per_proxy:
+            return []
+        return [x for x, count in self.proxies.items() if count >= self.max_per_proxy]
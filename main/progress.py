@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# progress.py
+#
+# Partial results of running scans. Thug writes exploits, connections,
+# samples... to their collections as it finds them, minutes before an
+# extensive scan ends and club_collections merges them. run_thug tails
+# those collections by analysis id and notifies the consumer of the new
+# documents, which forwards them to the frontends that asked for progress.
+
+import logging
+import threading
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from main.notify import notify
+
+logger = logging.getLogger(__name__)
+
+# Collections tailed, the early indicators of compromise
+PROGRESS_COLLECTIONS = [
+    "exploits", "connections", "samples", "locations", "certificates", "behaviors",
+]
+
+# Document ids per notification, keeps the datagrams small
+IDS_PER_MESSAGE = 100
+
+
+class Tail(object):
+    """
+    Finds the documents added to the collections of an analysis since the
+    last poll. Thug inserts them with increasing ids.
+    """
+
+    def __init__(self, db, analysis_id, collections=PROGRESS_COLLECTIONS):
+        self.db = db
+        self.analysis_id = ObjectId(analysis_id)
+        self.collections = collections
+        self.last = {}
+
+    def poll(self):
+        """
+        Returns a dict mapping each collection to the ids of its new
+        documents, in insertion order.
+        """
+        new = {}
+        for name in self.collections:
+            query = {"analysis_id": self.analysis_id}
+            if name in self.last:
+                query["_id"] = {"$gt": self.last[name]}
+            ids = [x["_id"] for x in self.db[name].find(query, {"_id": True}).sort("_id", ASCENDING)]
+            if ids:
+                self.last[name] = ids[-1]
+                new[name] = ids
+        return new
+
+
+def messages(frontend_id, analysis_id, new):
+    """
+    Yields the notifications of the new documents returned by Tail.poll.
+    """
+    for name, ids in sorted(new.items()):
+        for i in range(0, len(ids), IDS_PER_MESSAGE):
+            yield {"frontend_id": str(frontend_id),
+                   "analysis_id": str(analysis_id),
+                   "collection": name,
+                   "ids": [str(x) for x in ids[i:i + IDS_PER_MESSAGE]]}
+
+
+class Watcher(threading.Thread):
+    """
+    Notifies port every interval seconds of the documents the analysis of a
+    scan added, from when output gets its analysis id until stop().
+    """
+
+    def __init__(self, db, frontend_id, output, interval, port):
+        super(Watcher, self).__init__(name="progress-{}".format(frontend_id))
+        self.daemon = True
+        self.db = db
+        self.frontend_id = frontend_id
+        self.output = output
+        self.interval = interval
+        self.port = port
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        tail = None
+        while not self.stopped.wait(self.interval):
+            if tail is None:
+                if self.output.analysis_id is None:
+                    continue
+                tail = Tail(self.db, self.output.analysis_id)
+            try:
+                for message in messages(self.frontend_id, tail.analysis_id, tail.poll()):
+                    notify(self.port, message)
+            except Exception as e:
+                logger.exception("Unable to look for the progress of {}: {}".format(
+                    tail.analysis_id, e))
+
+
+class Subscribers(object):
+    """
+    The requests waiting for a scan that asked for its progress, as
+    (channel, properties) tuples by frontend_id.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def add(self, frontend_id, ch, props):
+        with self.lock:
+            self.requests[frontend_id] = (ch, props)
+
+    def remove(self, frontend_id):
+        with self.lock:
+            self.requests.pop(frontend_id, None)
+
+    def get(self, frontend_id):
+        with self.lock:
+            return self.requests.get(frontend_id)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# resolver.py
+#
+# Resolves the hostnames of the flat tree nodes. Lookups for distinct
+# hostnames run concurrently on a bounded number of threads shared by all
+# the tasks of the daemon. A tree waits a fixed time for its lookups and
+# has at most a share of them queued at once, so a tree full of dead hosts
+# neither stalls nor holds back the others. Results (failures included)
+# are kept in a TTL + LRU cache.
+
+import logging
+import socket
+import threading
+import time
+import Queue
+
+from collections import OrderedDict
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def gethostbyname(hostname):
+    """
+    Default lookup function: returns the IP address of hostname, False if
+    it cannot be resolved.
+    """
+    try:
+        return socket.gethostbyname(hostname)
+    except (socket.gaierror, socket.herror, UnicodeError):
+        return False
+
+
+class Cache(object):
+    """
+    Thread-safe LRU cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a (found, value) tuple.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            expires_on, value = self.entries.pop(key)
+            if expires_on < time.time():
+                return False, None
+            self.entries[key] = (expires_on, value)  # most recently used
+            return True, value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Lookup(object):
+    """
+    A lookup queued or running, listeners are the events of the trees
+    waiting for it.
+    """
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.ip = False
+        self.done = threading.Event()
+        self.listeners = []
+
+
+class Resolver(object):
+    """
+    lookup is the function doing the actual resolution, it can be replaced
+    with a fake one for offline tests. resolve_all waits up to timeout
+    seconds and keeps up to share lookups (workers by default) queued.
+    """
+
+    def __init__(self, lookup=gethostbyname, workers=8, timeout=5,
+                 ttl=300, cache_size=10000, share=None):
+        self.lookup = lookup
+        self.workers = workers
+        self.timeout = timeout
+        self.share = share or workers
+        self.cache = Cache(cache_size, ttl)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.running = {}  # lookups in progress by hostname
+        self.started = False
+
+    def _start(self):
+        # Threads are started on first use, not at import time
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work,
+                                      name="resolver-{}".format(i))
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if not job.listeners:
+                    # All the trees waiting for it gave up
+                    self.running.pop(job.hostname, None)
+                    continue
+            try:
+                job.ip = self.lookup(job.hostname)
+            except Exception as e:
+                logger.debug("Unable to resolve {}: {}".format(job.hostname, e))
+                job.ip = False
+            # Also cached when the caller gave up waiting: next time the
+            # answer is already there
+            self.cache.set(job.hostname, job.ip)
+            with self.lock:
+                self.running.pop(job.hostname, None)
+                job.done.set()
+                for listener in job.listeners:
+                    listener.set()
+
+    def _submit(self, hostname, listener):
+        with self.lock:
+            job = self.running.get(hostname)
+            if job is None:
+                job = self.running[hostname] = Lookup(hostname)
+                self.queue.put(job)
+            job.listeners.append(listener)
+        return job
+
+    def _give_up(self, job, listener):
+        with self.lock:
+            if listener in job.listeners:
+                job.listeners.remove(listener)
+
+    def resolve_all(self, hostnames):
+        """
+        Returns a dict mapping each hostname to its IP address, or to False
+        if it could not be resolved in time.
+        """
+        self._start()
+        deadline = time.time() + self.timeout
+        result = {}
+        todo = []
+        for hostname in set(hostnames):
+            found, ip = self.cache.get(hostname)
+            if found:
+                result[hostname] = ip
+            else:
+                todo.append(hostname)
+
+        # Set whenever one of our lookups is done
+        listener = threading.Event()
+        jobs = []
+        while todo or jobs:
+            while todo and len(jobs) < self.share:
+                jobs.append(self._submit(todo.pop(), listener))
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            listener.wait(remaining)
+            listener.clear()
+            for job in [x for x in jobs if x.done.is_set()]:
+                result[job.hostname] = job.ip
+                jobs.remove(job)
+                self._give_up(job, listener)
+
+        for job in jobs:
+            self._give_up(job, listener)
+        if jobs or todo:
+            logger.debug("Timeout resolving {} hostnames".format(len(jobs) + len(todo)))
+        for hostname in todo + [x.hostname for x in jobs]:
+            result[hostname] = False
+
+        return result
+
+    def resolve_urls(self, urls):
+        """
+        Returns a dict mapping each url to the IP address of its host, or to
+        False if it could not be resolved.
+        """
+        hosts = dict((url, urlparse(url).hostname) for url in set(urls))
+        ips = self.resolve_all(host for host in hosts.values() if host)
+        return dict((url, ips.get(host, False)) for url, host in hosts.items())
@@ -20,21 +20,118 @@
 #           The Honeynet Project
 #
 
-from pymongo import MongoClient
-from bson import ObjectId
+import itertools
+import re
+
+import pymongo
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 
 from tastypie.bundle import Bundle
+from tastypie.exceptions import ImmediateHttpResponse, InvalidFilterError
 from tastypie.resources import Resource
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.constants import LOOKUP_SEP
-from django.http import QueryDict
+from django.http import HttpResponse, QueryDict
+
+from main.mongo import get_client
 
 # TODO: See if this one is better than reinventing the wheel: http://django-tastypie-mongoengine.readthedocs.org/en/latest/
 
-# TODO: support more QUERY_TERMS such as 'text', 'near', 'all', 'elemMatch', 'size', etc.
-QUERY_TERMS = ['exact', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin', 'regex', 'iregex']
+# TODO: support more QUERY_TERMS such as 'near', 'geoWithin', etc.
+QUERY_TERMS = ['exact', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin', 'all', 'regex', 'iregex',
+               'startswith', 'istartswith', 'text', 'elemMatch', 'size', 'exists']
+
+# Terms whose value is a comma separated list
+LIST_TERMS = ['in', 'nin', 'all']
+
+# Terms whose value is compared with the field, so ids must be ObjectIds
+VALUE_TERMS = ['exact', 'ne', 'gt', 'gte', 'lt', 'lte'] + LIST_TERMS
+
+# Filter plans kept by each resource
+FILTER_PLANS = 256
+
+db = get_client().thug
+
+# Query string parameters that are not filters
+FIELDS_PARAM = 'fields'  # comma separated fields to return, default all
+AFTER_PARAM = 'after'  # id of the last object of the previous page
+EXPLAIN_PARAM = 'explain'  # reply with the query plan instead of the objects
+
+
+def _plan_stages(plan):
+    """
+    Yields the stages of a query plan and of its input stages.
+    """
+    yield plan.get('stage')
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            for stage in _plan_stages(child):
+                yield stage
+
+
+class MongoQuerySet(object):
+    """
+    The documents matching a query, fetched lazily. Tastypie's paginator
+    only calls count() and slices it, so both run on the server and a page
+    never loads more than its own documents.
+    """
+
+    def __init__(self, collection, object_class, spec, projection=None):
+        self.collection = collection
+        self.object_class = object_class
+        self.spec = spec
+        self.projection = projection
+
+    def _cursor(self):
+        # Sorted on _id so pages are stable, and the index serves the sort
+        return self.collection.find(self.spec, self.projection).sort('_id', pymongo.ASCENDING)
 
-db = MongoClient().thug
+    def count(self):
+        return self.collection.count(self.spec)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return itertools.imap(self.object_class, self._cursor())
+
+    def explain(self):
+        """
+        Returns the query, its winning plan and whether it used an index
+        rather than scanning the collection.
+        """
+        explanation = self._cursor().explain()
+        if 'queryPlanner' in explanation:
+            plan = explanation['queryPlanner']['winningPlan']
+            index_used = 'COLLSCAN' not in _plan_stages(plan)
+        else:
+            # MongoDB before 3.0
+            plan = explanation
+            index_used = not explanation.get('cursor', '').startswith('BasicCursor')
+        return {
+            'query': self.spec,
+            'projection': self.projection,
+            'index_used': index_used,
+            'plan': plan,
+        }
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Slices with a step are not supported")
+            start = key.start or 0
+            cursor = self._cursor().skip(start)
+            if key.stop is not None:
+                if key.stop <= start:
+                    return iter([])
+                cursor = cursor.limit(key.stop - start)
+            return itertools.imap(self.object_class, cursor)
+
+        documents = list(self._cursor().skip(key).limit(1))
+        if not documents:
+            raise IndexError(key)
+        return self.object_class(documents[0])
 
 
 class MongoDBResource(Resource):
@@ -45,6 +142,10 @@ class MongoDBResource(Resource):
     - https://github.com/django-tastypie/django-tastypie/blob/master/tastypie/resources.py
     """
 
+    def __init__(self, *args, **kwargs):
+        super(MongoDBResource, self).__init__(*args, **kwargs)
+        self._filter_plans = {}
+
     def detail_uri_kwargs(self, bundle_or_obj):
         """
         Given a ``Bundle`` or an object, it returns the extra kwargs needed
@@ -91,6 +192,11 @@ class MongoDBResource(Resource):
 
         obj_list = self.authorized_read_list(obj_list, bundle)
 
+        explain = getattr(bundle.request, 'GET', {}).get(EXPLAIN_PARAM, '')
+        if explain.lower() in ['1', 'true', 'yes']:
+            raise ImmediateHttpResponse(response=HttpResponse(
+                json_util.dumps(obj_list.explain()), content_type='application/json'))
+
         return obj_list
 
     def obj_get(self, bundle, **kwargs):
@@ -110,7 +216,24 @@ class MongoDBResource(Resource):
         return self._get_object_class()(obj)
 
     def apply_filters(self, request, applicable_filters):
-        return list(map(self._get_object_class(), self._get_collection().find(applicable_filters)))
+        projection = None
+        params = getattr(request, 'GET', {})
+
+        if params.get(FIELDS_PARAM):
+            projection = dict((x.strip(), True) for x in params[FIELDS_PARAM].split(',') if x.strip())
+
+        if params.get(AFTER_PARAM):
+            # Keyset pagination, cheaper than skipping over the previous pages
+            try:
+                after = ObjectId(params[AFTER_PARAM])
+            except (TypeError, InvalidId) as e:
+                raise InvalidFilterError("Invalid value for '{}': {}".format(AFTER_PARAM, e))
+            applicable_filters = {'$and': [applicable_filters, {
+                '_id': {'$gt': after}
+            }]}
+
+        return MongoQuerySet(self._get_collection(), self._get_object_class(),
+                             applicable_filters, projection)
 
     def build_filters(self, filters):
         applicable_filters = {}
@@ -118,27 +241,34 @@ class MongoDBResource(Resource):
             filters = filters.dict()
 
         for filter_expr, value in filters.items():
-            filter_bits = filter_expr.split(LOOKUP_SEP, 1) # We do not support field lookups as data is not ORM-based, so maxsplit=1
-            field_name = filter_bits.pop(0)
-            filter_type = 'exact'
-
-            if not field_name in self.fields:
+            plan = self._filter_plan(filter_expr)
+            if plan is None:
                 # It's not a field we know about. Move along citizen.
                 continue
+            field_name, filter_type = plan
 
-            if len(filter_bits) and filter_bits[-1] in QUERY_TERMS:
-                filter_type = filter_bits.pop()
+            if filter_type == 'text':
+                # Searches the text index of the collection, whatever the field
+                applicable_filters['$text'] = {'$search': value}
+                continue
 
-            if field_name == 'id' or field_name.endswith('_id'):
-                # All IDs are represented as strings, but must be converted to ObjectId()
-                value = ObjectId(value)
+            value = self._filter_value(field_name, filter_type, value)
 
             if filter_type == 'exact':
                 applicable_filters[field_name] = value
-            elif filter_type in ['gt', 'gte', 'lt', 'lte', 'ne', 'nin', 'in']:
+            elif filter_type in ['gt', 'gte', 'lt', 'lte', 'ne', 'nin', 'in', 'all', 'size', 'exists',
+                                 'elemMatch']:
                 applicable_filters[field_name] = {
                     "${}".format(filter_type): value
                 }
+            elif filter_type.endswith('startswith'):
+                # Anchored on a literal prefix: startswith can use an index on
+                # the field, istartswith (case insensitive) still scans it
+                applicable_filters[field_name] = {
+                    '$regex': '^' + re.escape(value)
+                }
+                if filter_type.startswith('i'):
+                    applicable_filters[field_name]['$options'] = 'i'
             elif filter_type.endswith('regex'):
                 applicable_filters[field_name] = {
                     '$regex': value
@@ -148,6 +278,58 @@ class MongoDBResource(Resource):
 
         return applicable_filters
 
+    def _filter_plan(self, filter_expr):
+        """
+        Returns the (field_name, filter_type) of a query string term, or None
+        if it is not a filter. Plans are cached, list requests keep using the
+        same few terms.
+        """
+        plans = self._filter_plans
+        try:
+            return plans[filter_expr]
+        except KeyError:
+            pass
+
+        filter_bits = filter_expr.split(LOOKUP_SEP, 1) # We do not support field lookups as data is not ORM-based, so maxsplit=1
+        field_name = filter_bits.pop(0)
+        filter_type = 'exact'
+
+        if not field_name in self.fields:
+            plan = None
+        else:
+            if len(filter_bits) and filter_bits[-1] in QUERY_TERMS:
+                filter_type = filter_bits.pop()
+            plan = field_name, filter_type
+
+        if len(plans) >= FILTER_PLANS:
+            plans.clear()
+        plans[filter_expr] = plan
+        return plan
+
+    def _filter_value(self, field_name, filter_type, value):
+        try:
+            if filter_type in LIST_TERMS:
+                value = value.split(',')
+            elif filter_type == 'size':
+                return int(value)
+            elif filter_type == 'exists':
+                return value.lower() in ['1', 'true', 'yes']
+            elif filter_type == 'elemMatch':
+                value = json_util.loads(value)
+                if not isinstance(value, dict):
+                    raise ValueError("elemMatch needs a JSON object")
+                return value
+
+            if filter_type in VALUE_TERMS and (field_name == 'id' or field_name.endswith('_id')):
+                # All IDs are represented as strings, but must be converted to ObjectId()
+                if isinstance(value, list):
+                    return [ObjectId(x) for x in value]
+                return ObjectId(value)
+        except (ValueError, InvalidId) as e:
+            raise InvalidFilterError("Invalid value for '{}__{}': {}".format(field_name, filter_type, e))
+
+        return value
+
     def _get_object_class(self):
         return self._meta.object_class
 
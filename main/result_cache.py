@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# result_cache.py
+#
+# The frontend often submits again a URL it scanned minutes before, with
+# the same options. A completed task with the same normalized URL and
+# option values, completed within the freshness window, answers such a
+# request without running Thug: the new task points to its analysis.
+
+import hashlib
+import json
+import urlparse
+from datetime import timedelta
+
+from bson import ObjectId
+from django.db.models import F
+
+from main.models import Task, add_now
+from main.utils import STATUS_COMPLETED
+
+# Task fields that change the outcome of a Thug run
+OPTION_FIELDS = [
+    'referer', 'useragent', 'proxy_id',
+    'events', 'delay', 'timeout', 'threshold', 'no_cache', 'extensive', 'broken_url',
+    'verbose', 'quiet', 'debug', 'ast_debug', 'http_debug',
+    'vtquery', 'vtsubmit', 'no_honeyagent',
+    'adobepdf', 'no_adobepdf', 'shockwave', 'no_shockwave', 'javaplugin', 'no_javaplugin',
+]
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    Lowercases scheme and host, drops default ports and fragments.
+    """
+    url = url.strip()
+    parts = urlparse.urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = "{}:{}".format(netloc, parts.port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ":" + parts.password
+        netloc = userinfo + "@" + netloc
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def options_hash(task):
+    """
+    Returns the SHA-256 of the normalized URL and option values of a task.
+    """
+    key = [normalize_url(task.url), dict((x, getattr(task, x)) for x in OPTION_FIELDS)]
+    return hashlib.sha256(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def find_result(task, freshness, analyses):
+    """
+    Returns the object_id of the analysis of a completed task matching task
+    and completed less than freshness seconds ago, None if there is none.
+    analyses is the analysiscombo collection, the analysis must still be in.
+    """
+    if task.no_cache:
+        return None
+
+    # Only real scans: cache hits start and complete at once, matching them
+    # would renew an old analysis on every request within the window
+    candidates = Task.objects.filter(
+        options_hash=task.options_hash,
+        status=STATUS_COMPLETED,
+        completed_on__gte=add_now() - timedelta(seconds=freshness),
+        completed_on__gt=F('started_on'),
+        object_id__isnull=False
+    ).exclude(pk=task.pk).order_by('-completed_on').values_list('object_id', flat=True)
+
+    for object_id in candidates[:3]:
+        if analyses.find_one({"_id": ObjectId(object_id)}, {"_id": True}):
+            return object_id
+    return None
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# scheduler.py
+#
+# Chooses which new tasks run_thug starts when workers are free. Tasks of
+# a higher priority always go first. Within a priority, the free workers
+# are shared between the queues in proportion to their weights, then
+# between the users of each queue, counting the tasks they already have
+# running: a user submitting thousands of URLs gets no more workers than
+# one submitting a single scan.
+
+
+def schedule(waiting, running, slots, weights=None):
+    """
+    waiting lists the groups of new tasks as (priority, user, queue, count,
+    oldest) tuples, running maps (user, queue) to the number of tasks
+    running. Returns a dict mapping (priority, user, queue) to the number of
+    tasks of the group to start, slots at most.
+    """
+    weights = weights or {}
+    left = dict(((priority, user, queue), count)
+                for priority, user, queue, count, oldest in waiting)
+    oldest = dict(((priority, user, queue), submitted)
+                  for priority, user, queue, count, submitted in waiting)
+
+    running = dict(running)
+    queue_running = {}
+    for (user, queue), count in running.items():
+        queue_running[queue] = queue_running.get(queue, 0) + count
+
+    chosen = {}
+    for _ in range(slots):
+        groups = [x for x, count in left.items() if count > 0]
+        if not groups:
+            break
+        priority = max(x[0] for x in groups)
+        groups = [x for x in groups if x[0] == priority]
+
+        # The queue furthest behind its share, then its user with the
+        # fewest tasks running; the longest waiting breaks ties
+        queue = min(set(x[2] for x in groups),
+                    key=lambda q: (queue_running.get(q, 0) / float(weights.get(q, 1)),
+                                   min(oldest[x] for x in groups if x[2] == q)))
+        group = min((x for x in groups if x[2] == queue),
+                    key=lambda x: (running.get((x[1], x[2]), 0), oldest[x]))
+
+        left[group] -= 1
+        chosen[group] = chosen.get(group, 0) + 1
+        running[(group[1], group[2])] = running.get((group[1], group[2]), 0) + 1
+        queue_running[queue] = queue_running.get(queue, 0) + 1
+
+    return chosen
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# backend_config.py
+#
+# Checks parsing and reloading of the backend configuration.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from main.config import BackendConfig
+from main.mongo import client_options
+
+
+class TestBackendConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "backend.conf")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_defaults(self):
+        config = BackendConfig(self.path)
+
+        self.assertEqual(config.backend.host, 'localhost')
+        self.assertTrue(config.backend.is_master)
+        self.assertEqual(config.backend.prefetch, 1)
+        self.assertEqual(config.thug.timeout, 600)
+        self.assertEqual(config.docker, ["/usr/bin/docker"])
+        self.assertEqual(config.image, "thugsrumal/thug_docker:latest")
+
+    def test_types_and_limits(self):
+        self.write("[backend]\n"
+                   "is_master = False\n"
+                   "file_transfer = carrier pigeon\n"
+                   "chunk_size = 10\n"
+                   "[thug]\n"
+                   "use_sudo = True\n"
+                   "workers = 4\n"
+                   "timeout = ten\n"
+                   "dns_timeout = 0.5\n"
+                   "docker_tag = v0.6\n"
+                   "mongodb = 10.0.0.1:27017\n")
+        config = BackendConfig(self.path)
+
+        self.assertFalse(config.backend.is_master)
+        self.assertEqual(config.backend.file_transfer, 'inline')
+        self.assertEqual(config.backend.chunk_size, 1024)
+        self.assertEqual(config.backend.prefetch, 4)
+        self.assertEqual(config.thug.timeout, 600)
+        self.assertEqual(config.thug.dns_timeout, 0.5)
+        self.assertEqual(config.docker, ["/usr/bin/sudo", "/usr/bin/docker"])
+        self.assertEqual(config.image, "thugsrumal/thug_docker:v0.6")
+        self.assertEqual(config.mongodb_address(), "10.0.0.1:27017")
+
+    def test_reload(self):
+        self.write("[thug]\ntimeout = 60\n")
+        config = BackendConfig(self.path)
+        thug = config.thug
+
+        self.write("[thug]\ntimeout = 120\n")
+        config.reload()
+
+        self.assertEqual(config.thug.timeout, 120)
+        self.assertEqual(thug.timeout, 60)
+
+    def test_mongo_client_options(self):
+        self.write("[thug]\nworkers = 4\n"
+                   "[mongodb]\nsocket_timeout = 0\nw = majority\n")
+        options = client_options(BackendConfig(self.path).mongodb)
+
+        self.assertEqual(options["maxPoolSize"], 16)
+        self.assertEqual(options["connectTimeoutMS"], 10000)
+        self.assertIsNone(options["socketTimeoutMS"])
+        self.assertEqual(options["w"], "majority")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# bulk_scan.py
+#
+# Checks the handling of the scans of bulk messages.
+#
+
+import unittest
+
+from main.bulk import BULK_BATCH_SIZE, BulkReply, chunks, unique_scans
+from main.utils import STATUS_COMPLETED, STATUS_FAILED
+
+
+class TestBulkScan(unittest.TestCase):
+
+    def test_chunks(self):
+        ids = [str(x) for x in range(2 * BULK_BATCH_SIZE + 1)]
+        parts = list(chunks(ids))
+
+        self.assertEqual([len(x) for x in parts], [BULK_BATCH_SIZE, BULK_BATCH_SIZE, 1])
+        self.assertEqual(sum(parts, []), ids)
+        self.assertEqual(list(chunks([])), [])
+
+    def test_unique_scans(self):
+        scans = [{"frontend_id": 1, "url": "http://a.com"},
+                 {"frontend_id": 2, "url": "http://b.com"},
+                 {"frontend_id": "2", "url": "http://c.com"}]
+
+        self.assertEqual(unique_scans(scans), [{"frontend_id": 1, "url": "http://a.com"},
+                                               {"frontend_id": "2", "url": "http://c.com"}])
+
+    def test_bulk_reply(self):
+        bulk = BulkReply(["1", "2"])
+
+        self.assertFalse(bulk.done("1", STATUS_COMPLETED))
+        self.assertFalse(bulk.done("1", STATUS_COMPLETED))
+        self.assertTrue(bulk.done("2", STATUS_FAILED))
+        self.assertFalse(bulk.done("2", STATUS_FAILED))
+        self.assertEqual(bulk.results, {"1": STATUS_COMPLETED, "2": STATUS_FAILED})
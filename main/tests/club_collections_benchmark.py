@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# club_collections_benchmark.py
+#
+# Counts the MongoDB round trips taken by club_collections on the analysis
+# of issue 15 and compares them with the previous implementation, which
+# issued one urls lookup per exploit, certificate and connection endpoint.
+# You would need to run the mongo daemon to perform this test.
+#
+
+import unittest
+from bson import json_util
+import os
+import time
+import pymongo
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from main.management.commands import run_thug
+
+client = pymongo.MongoClient()
+db = client.thug
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'files', '0015_circular_reference_analysis')
+CIRCULAR_ANALYSIS_OBJECT_ID = '577ba91b2975c20001c6511f'
+
+
+class CountingCollection(object):
+
+    def __init__(self, database, collection):
+        self.database = database
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        self.database.queries += 1
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        self.database.queries += 1
+        return self.collection.find_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class CountingDatabase(object):
+    """
+    Wraps a pymongo Database, counting the queries issued through it.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.queries = 0
+
+    def __getitem__(self, name):
+        return CountingCollection(self, self.database[name])
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+class TestClubCollectionsRoundTrips(unittest.TestCase):
+
+    @staticmethod
+    def import_data(json_file, mongo_collection):
+
+        with open(os.path.join(FILES_DIR, json_file), 'r') as f:
+            for line in f:
+                try:
+                    mongo_collection.insert(json_util.loads(line))
+                except pymongo.errors.DuplicateKeyError:
+                    pass
+
+    def setUp(self):
+        for name in ['analyses', 'behaviors', 'certificates', 'codes',
+                     'connections', 'locations', 'pcaps', 'urls']:
+            self.import_data('{}.json'.format(name), db[name])
+
+    def test_round_trips(self):
+        counting = CountingDatabase(db)
+        run_thug.db = counting
+        try:
+            start = time.time()
+            analysis = run_thug.Command().club_collections(CIRCULAR_ANALYSIS_OBJECT_ID)
+            elapsed = time.time() - start
+        finally:
+            run_thug.db = db
+
+        # analyses + one per child collection + urls
+        self.assertEqual(counting.queries, len(run_thug.CHILD_COLLECTIONS) + 2)
+
+        # analyses + one per child collection + first url + one per
+        # exploit and certificate + two per connection
+        previous = (len(run_thug.CHILD_COLLECTIONS) + 2 +
+                    len(analysis["exploits"]) +
+                    len(analysis["certificates"]) +
+                    2 * len(analysis["connections"]))
+
+        print "club_collections: {} queries (previously {}) in {:.3f}s".format(
+            counting.queries, previous, elapsed)
+        self.assertLess(counting.queries, previous)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# container_pool.py
+#
+# Checks the warm Thug container pool against a fake docker, so it does
+# not need docker.
+#
+
+import os
+import socket
+import threading
+import unittest
+
+from main.containers import ContainerPool, owner_alive
+
+
+class FakeDocker(object):
+    """
+    Stands in for subprocess.check_output running docker: keeps track of
+    the running containers.
+    """
+
+    def __init__(self, owners=None):
+        self.owners = dict(owners or {})
+        self.started = 0
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return set(self.owners)
+
+    def __call__(self, args):
+        assert args[0] == "docker", args
+        with self.lock:
+            if args[1] == "run":
+                self.started += 1
+                container_id = "container{}".format(self.started)
+                label = args[args.index("--label") + 1]
+                self.owners[container_id] = label.split("=", 1)[1]
+                return container_id + "\n"
+            if args[1] == "rm":
+                self.owners.pop(args[-1], None)
+                return args[-1] + "\n"
+            if args[1] == "ps":
+                return "".join("{} {}\n".format(*x) for x in self.owners.items())
+
+
+class TestContainerPool(unittest.TestCase):
+
+    def make_pool(self, docker, size=2, recycle_after=3, alive=lambda owner: True):
+        pool = ContainerPool(["docker"], "thugsrumal/thug_docker:latest",
+                             size, recycle_after, "host:1", run=docker, alive=alive)
+        pool.start()
+        return pool
+
+    def test_exec_in_warm_container(self):
+        docker = FakeDocker()
+        pool = self.make_pool(docker)
+
+        container = pool.acquire(timeout=5)
+        self.assertIn(container.id, docker.running)
+        self.assertEqual(pool.exec_args(container, ["thug", "http://example.com"]),
+                         ["docker", "exec", "-e", "PYTHONUNBUFFERED=1", container.id,
+                          "thug", "http://example.com"])
+
+        pool.release(container)
+        self.assertIsNotNone(pool.acquire(timeout=5))
+        self.assertIsNotNone(pool.acquire(timeout=5))
+        self.assertIsNone(pool.acquire(timeout=0.1))  # all busy
+        self.assertEqual(docker.started, 2)
+
+    def test_recycle_after_scans(self):
+        docker = FakeDocker()
+        pool = self.make_pool(docker, size=1, recycle_after=3)
+
+        first = pool.acquire(timeout=5)
+        pool.release(first)
+        for _ in range(2):
+            container = pool.acquire(timeout=5)
+            self.assertEqual(container.id, first.id)
+            pool.release(container)
+
+        container = pool.acquire(timeout=5)
+        self.assertNotEqual(container.id, first.id)
+        self.assertNotIn(first.id, docker.running)
+
+    def test_recycle_on_failure(self):
+        docker = FakeDocker()
+        pool = self.make_pool(docker, size=1)
+
+        container = pool.acquire(timeout=5)
+        pool.release(container, failed=True)
+
+        replacement = pool.acquire(timeout=5)
+        self.assertNotEqual(replacement.id, container.id)
+        self.assertEqual(docker.running, set([replacement.id]))
+
+    def test_shutdown(self):
+        docker = FakeDocker()
+        pool = self.make_pool(docker)
+
+        busy = pool.acquire(timeout=5)
+        pool.release(pool.acquire(timeout=5))  # waits for the second one
+        pool.shutdown()
+        self.assertEqual(docker.running, set())
+
+        # The scan in the busy one ends
+        pool.release(busy)
+        self.assertEqual(docker.running, set())
+
+    def test_remove_stale(self):
+        docker = FakeDocker({"old": "host:2", "other": "host:3"})
+        pool = self.make_pool(docker, alive=lambda owner: owner == "host:3")
+
+        container = pool.acquire(timeout=5)
+        self.assertEqual(docker.owners[container.id], "host:1")
+        self.assertNotIn("old", docker.running)
+        self.assertIn("other", docker.running)
+
+    def test_owner_alive(self):
+        host = socket.gethostname()
+
+        self.assertTrue(owner_alive("{}:{}".format(host, os.getpid())))
+        self.assertFalse(owner_alive("{}:{}".format(host, 2 ** 22 + 1)))  # above pid_max
+        self.assertTrue(owner_alive("elsewhere:1"))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#
+# content_index.py
+#
+# Checks the hashing of the content of the files and its lookup by hash.
+# You would need to run the mongo daemon to perform this test.
+#
+
+import hashlib
+import unittest
+import pymongo
+from bson import ObjectId
+
+from main.content_index import ContentIndex
+
+TEST_DATABASE = "test_thug"
+
+
+class TestContentIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = pymongo.MongoClient()
+        self.db = self.mongo[TEST_DATABASE]
+        self.files = {}
+        self.read = []
+        self.index = ContentIndex(self.db.content_index, self.iter_file)
+
+    def tearDown(self):
+        self.mongo.drop_database(TEST_DATABASE)
+
+    def iter_file(self, file_id):
+        self.read.append(file_id)
+        for chunk in self.files[file_id]:
+            yield chunk
+
+    def test_digest(self):
+        file_id = ObjectId()
+        self.files[file_id] = ["<script>", "alert(1)", "</script>"]
+        expected = (hashlib.sha256("<script>alert(1)</script>").hexdigest(), 25)
+
+        self.assertEqual(self.index.digest(file_id), expected)
+        self.assertEqual(self.index.digest(file_id), expected)
+        self.assertEqual(self.read, [file_id])
+        self.assertEqual(self.index.find(expected[0]), file_id)
+
+    def test_find_missing(self):
+        file_id = ObjectId()
+        self.files[file_id] = []
+        self.assertEqual(self.index.digest(file_id), (hashlib.sha256().hexdigest(), 0))
+        self.assertIsNone(self.index.find(hashlib.sha256("unknown").hexdigest()))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# dns_resolver.py
+#
+# Checks the flat tree DNS resolver with fake lookup functions, so it does
+# not need network access.
+#
+
+import threading
+import time
+import unittest
+
+from main.resolver import Resolver
+
+
+class CountingLookup(object):
+
+    def __init__(self, delay=0, answers=None):
+        self.delay = delay
+        self.answers = answers or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, hostname):
+        with self.lock:
+            self.calls.append(hostname)
+        time.sleep(self.delay)
+        return self.answers.get(hostname, False)
+
+
+class TestResolver(unittest.TestCase):
+
+    def test_deduplicates_hostnames(self):
+        lookup = CountingLookup(answers={'a.example.com': '10.0.0.1'})
+        resolver = Resolver(lookup=lookup)
+
+        ips = resolver.resolve_urls(['http://a.example.com/1',
+                                     'http://a.example.com:8080/2',
+                                     'http://b.example.com/'])
+
+        self.assertEqual(ips, {'http://a.example.com/1': '10.0.0.1',
+                               'http://a.example.com:8080/2': '10.0.0.1',
+                               'http://b.example.com/': False})
+        self.assertEqual(sorted(lookup.calls), ['a.example.com', 'b.example.com'])
+
+    def test_concurrent_lookups(self):
+        lookup = CountingLookup(delay=0.2)
+        resolver = Resolver(lookup=lookup, workers=10)
+
+        start = time.time()
+        resolver.resolve_all(['host{}'.format(i) for i in range(10)])
+
+        self.assertLess(time.time() - start, 1)
+
+    def test_timeout(self):
+        lookup = CountingLookup(delay=1, answers={'slow': '10.0.0.2'})
+        resolver = Resolver(lookup=lookup, timeout=0.1)
+
+        start = time.time()
+        self.assertEqual(resolver.resolve_all(['slow']), {'slow': False})
+        self.assertLess(time.time() - start, 0.5)
+
+        # The late answer is cached for the next task
+        time.sleep(1.2)
+        self.assertEqual(resolver.resolve_all(['slow']), {'slow': '10.0.0.2'})
+        self.assertEqual(lookup.calls, ['slow'])
+
+    def test_cache_expiry_and_size(self):
+        lookup = CountingLookup()
+        resolver = Resolver(lookup=lookup, ttl=0.2, cache_size=2)
+
+        resolver.resolve_all(['a', 'b'])
+        resolver.resolve_all(['a', 'b'])
+        self.assertEqual(len(lookup.calls), 2)
+
+        resolver.resolve_all(['c'])  # evicts a, the least recently used
+        resolver.resolve_all(['a'])
+        self.assertEqual(len(lookup.calls), 4)
+
+        time.sleep(0.3)
+        resolver.resolve_all(['a'])
+        self.assertEqual(len(lookup.calls), 5)
+
+    def test_fixed_deadline(self):
+        lookup = CountingLookup(delay=0.2)
+        resolver = Resolver(lookup=lookup, workers=2, timeout=0.3)
+
+        start = time.time()
+        ips = resolver.resolve_all(['dead{}'.format(i) for i in range(100)])
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(set(ips.values()), set([False]))
+
+        # Lookups given up are not run
+        time.sleep(0.5)
+        self.assertLessEqual(len(lookup.calls), 6)
+
+    def test_share(self):
+        lookup = CountingLookup(delay=0.1, answers={'small': '10.0.0.3'})
+        resolver = Resolver(lookup=lookup, workers=2, timeout=10)
+
+        big = threading.Thread(target=resolver.resolve_all,
+                               args=(['big{}'.format(i) for i in range(40)],))
+        big.daemon = True
+        big.start()
+        time.sleep(0.05)
+
+        start = time.time()
+        self.assertEqual(resolver.resolve_all(['small']), {'small': '10.0.0.3'})
+        self.assertLess(time.time() - start, 0.5)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# file_streaming.py
+#
+# Checks the decoding of the files stored in GridFS a chunk at a time and
+# the chunk messages streamed to the callback queue.
+#
+
+import base64
+import os
+import unittest
+from StringIO import StringIO
+
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+import gridfs
+import pika
+
+from main.config import config
+from main.management.commands import consumer
+from main.utils import DownloadError, FILE_CHUNK
+
+CHUNK_SIZE = 1024
+
+# Decoded bytes per chunk: the base64 characters read are a multiple of 4
+DECODED_CHUNK = CHUNK_SIZE / 3 * 3
+
+
+class FakeGridFS(object):
+    """
+    Files stored base64 encoded, as Thug does.
+    """
+
+    def __init__(self, files):
+        self.files = dict((k, base64.b64encode(v)) for k, v in files.items())
+
+    def get(self, file_id):
+        if file_id not in self.files:
+            raise gridfs.errors.NoFile(file_id)
+        return StringIO(self.files[file_id])
+
+
+class FakeChannel(object):
+    """
+    Runs the threadsafe callbacks right away and keeps the published
+    messages.
+    """
+
+    is_open = True
+
+    def __init__(self):
+        self.connection = self
+        self.published = []
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        self.published.append((routing_key, properties, body))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.content = bytearray(range(256)) * 10
+        self.fs = consumer.fs
+        consumer.fs = FakeGridFS({"script": str(self.content), "empty": ""})
+        self.chunk_size = config.backend.chunk_size
+        config.backend.chunk_size = CHUNK_SIZE
+        self.command = consumer.Command()
+        self.props = pika.BasicProperties(correlation_id="7", reply_to="callback")
+
+    def tearDown(self):
+        consumer.fs = self.fs
+        config.backend.chunk_size = self.chunk_size
+
+    def test_iter_file(self):
+        chunks = list(self.command.iter_file("script"))
+
+        self.assertEqual([len(x) for x in chunks], [DECODED_CHUNK, DECODED_CHUNK, 514])
+        self.assertEqual("".join(chunks), str(self.content))
+        self.assertEqual(list(self.command.iter_file("empty")), [])
+        self.assertRaises(DownloadError, list, self.command.iter_file("missing"))
+
+    def test_stream_files(self):
+        ch = FakeChannel()
+        sent = self.command.stream_files(ch, self.props, [({"content_id": 1}, "script")])
+
+        self.assertEqual([x[0] for x in ch.published], ["callback"] * 3)
+        self.assertEqual("".join(x[2] for x in ch.published), str(self.content))
+        properties = [x[1] for x in ch.published]
+        self.assertEqual([x.type for x in properties], [FILE_CHUNK] * 3)
+        self.assertEqual([x.correlation_id for x in properties], ["7"] * 3)
+        self.assertEqual([x.headers["seq"] for x in properties], [0, 1, 2])
+        self.assertEqual([x.headers["last"] for x in properties], [False, False, True])
+        self.assertEqual([x.headers["content_id"] for x in properties], ["1"] * 3)
+        mime = properties[0].headers["mime"]
+        self.assertEqual([x.headers["mime"] for x in properties], [mime] * 3)
+        self.assertEqual(sent, [{"content_id": 1, "mime": mime, "size": len(self.content), "chunks": 3}])
+
+    def test_stream_empty_file(self):
+        ch = FakeChannel()
+        sent = self.command.stream_files(ch, self.props, [({"content_id": 2}, "empty")])
+
+        self.assertEqual(len(ch.published), 1)
+        routing_key, properties, body = ch.published[0]
+        self.assertEqual(body, "")
+        self.assertEqual(properties.headers["seq"], 0)
+        self.assertTrue(properties.headers["last"])
+        self.assertEqual(sent[0]["size"], 0)
+        self.assertEqual(sent[0]["chunks"], 1)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# mongo_indexes.py
+#
+# Checks the creation of the indexes of the Thug collections and the
+# detection of unindexed queries in the MongoDB profile.
+# You would need to run the mongo daemon to perform this test.
+#
+
+import unittest
+import os
+import pymongo
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from main import indexes
+
+TEST_DATABASES = {"thug": "test_thug", "thugfs": "test_thugfs"}
+
+
+class RenamingClient(object):
+    """
+    Points the backend databases to test ones.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, name):
+        return self.client[TEST_DATABASES[name]]
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = pymongo.MongoClient()
+        self.client = RenamingClient(self.mongo)
+
+    def tearDown(self):
+        for name in TEST_DATABASES.values():
+            self.mongo.drop_database(name)
+
+    def test_ensure_indexes(self):
+        required = indexes.required_indexes()
+        self.assertEqual(indexes.missing_indexes(self.client), required)
+
+        self.assertEqual(indexes.ensure_indexes(self.client), required)
+        self.assertEqual(indexes.missing_indexes(self.client), [])
+        self.assertEqual(indexes.ensure_indexes(self.client), [])
+
+    def test_compound_index_prefix(self):
+        self.client["thug"].codes.create_index([("analysis_id", pymongo.ASCENDING),
+                                                ("url_id", pymongo.ASCENDING)])
+
+        missing = indexes.missing_indexes(self.client)
+        self.assertNotIn(("thug", "codes", [("analysis_id", pymongo.ASCENDING)]), missing)
+        self.assertIn(("thug", "behaviors", [("analysis_id", pymongo.ASCENDING)]), missing)
+
+    def test_collection_scan(self):
+        self.assertTrue(indexes._collection_scan({"planSummary": "COLLSCAN"}))
+        self.assertFalse(indexes._collection_scan({"planSummary": "IXSCAN { analysis_id: 1 }"}))
+        self.assertTrue(indexes._collection_scan({"nscanned": 0, "nscannedObjects": 1000}))
+        self.assertFalse(indexes._collection_scan({"nscanned": 10, "nscannedObjects": 10}))
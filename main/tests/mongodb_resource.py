@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# mongodb_resource.py
+#
+# Checks that MongoDBResource list requests page, project and filter on the
+# server instead of loading whole collections.
+# You would need to run the mongo daemon to perform this test.
+#
+
+import unittest
+import os
+import pymongo
+import django
+from bson import ObjectId
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from django.http import QueryDict
+from django.test import RequestFactory
+from tastypie import fields
+from tastypie.exceptions import InvalidFilterError
+from tastypie.paginator import Paginator
+
+from main.resources import MongoDBResource, _plan_stages
+
+client = pymongo.MongoClient()
+collection = client.test_thug.resource_documents
+
+DOCUMENTS = 10
+
+
+class Document(object):
+
+    def __init__(self, document=None):
+        self.__dict__.update(document or {})
+
+
+class DocumentResource(MongoDBResource):
+    url_id = fields.CharField(attribute='url_id', null=True)
+    url = fields.CharField(attribute='url', null=True)
+    tags = fields.ListField(attribute='tags', null=True)
+    score = fields.IntegerField(attribute='score', null=True)
+
+    class Meta:
+        resource_name = 'document'
+        object_class = Document
+
+    def _get_collection(self):
+        return collection
+
+
+class TestMongoDBResource(unittest.TestCase):
+
+    def setUp(self):
+        collection.drop()
+        self.url_ids = [ObjectId() for i in range(DOCUMENTS)]
+        self.ids = [collection.insert({"url": "http://example.com/{}".format(i), "score": i,
+                                       "url_id": self.url_ids[i]})
+                    for i in range(DOCUMENTS)]
+        self.resource = DocumentResource()
+
+    def tearDown(self):
+        collection.drop()
+
+    def get_list(self, query=''):
+        request = RequestFactory().get('/api/v1/document/?' + query)
+        return self.resource.obj_get_list(self.resource.build_bundle(request=request)), request
+
+    def test_pagination(self):
+        objects, request = self.get_list('url__regex=[2-9]$')
+        page = Paginator(QueryDict('limit=3&offset=3'), objects, limit=3).page()
+
+        self.assertEqual(page['meta']['total_count'], DOCUMENTS - 2)
+        self.assertEqual([x.score for x in page['objects']], [5, 6, 7])
+
+    def test_keyset_pagination(self):
+        objects, request = self.get_list('after={}&url__regex=[0-7]$'.format(self.ids[4]))
+
+        self.assertEqual(objects.count(), 3)
+        self.assertEqual([x.score for x in objects], [5, 6, 7])
+        self.assertEqual(objects[1].score, 6)
+
+        self.assertRaises(InvalidFilterError, self.get_list, 'after=nope')
+
+    def test_projection(self):
+        objects, request = self.get_list('fields=score')
+
+        document = list(objects[:1])[0]
+        self.assertEqual(document.score, 0)
+        self.assertFalse(hasattr(document, 'url'))
+
+    def test_query_terms(self):
+        collection.update_one({"_id": self.ids[0]}, {"$set": {"tags": ["a", "b"]}})
+        collection.update_one({"_id": self.ids[1]}, {"$set": {"tags": ["a"]}})
+
+        def scores(query):
+            return [x.score for x in self.get_list(query)[0]]
+
+        self.assertEqual(scores('url__startswith=http://example.com/1'), [1])
+        self.assertEqual(scores('url__istartswith=HTTP://EXAMPLE.COM/2'), [2])
+        self.assertEqual(scores('tags__all=a,b'), [0])
+        self.assertEqual(scores('tags__size=2'), [0])
+        self.assertEqual(scores('tags__exists=true'), [0, 1])
+        self.assertEqual(scores('url_id__in={},{}'.format(self.url_ids[3], self.url_ids[5])), [3, 5])
+
+    def test_filter_plans(self):
+        self.assertEqual(self.resource.build_filters({'url__startswith': 'http://a.'}),
+                         {'url': {'$regex': r'^http\:\/\/a\.'}})
+        self.assertEqual(self.resource._filter_plans['url__startswith'], ('url', 'startswith'))
+        self.assertIsNone(self.resource._filter_plan('limit'))
+
+    def test_invalid_filter(self):
+        self.assertRaises(InvalidFilterError, self.resource.build_filters, {'score__size': 'two'})
+        self.assertRaises(InvalidFilterError, self.resource.build_filters, {'url_id': 'nope'})
+
+    def test_plan_stages(self):
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+        self.assertEqual(list(_plan_stages(plan)), ['FETCH', 'IXSCAN'])
+        plan = {'stage': 'SORT', 'inputStage': {'stage': 'OR', 'inputStages': [{'stage': 'COLLSCAN'}]}}
+        self.assertIn('COLLSCAN', _plan_stages(plan))
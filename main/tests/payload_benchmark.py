@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# payload_benchmark.py
+#
+# Compares encode time, decode time and size of the reply payload formats
+# on a reply built out of the analysis of issue 15, with hexdumped files
+# like the ones the consumer sends inline. Does not need the mongo daemon.
+#
+
+import unittest
+from bson import json_util
+from bson.binary import Binary
+import hexdump
+import os
+import random
+import time
+
+from main import payload
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'files', '0015_circular_reference_analysis')
+ROUNDS = 3
+
+
+def analysis_reply():
+    """
+    Returns a completed scan reply holding every document of the analysis,
+    grouped by collection, and ten 64KB binary files.
+    """
+    analysis = {}
+    for json_file in sorted(os.listdir(FILES_DIR)):
+        with open(os.path.join(FILES_DIR, json_file), 'r') as f:
+            analysis[json_file[:-len('.json')]] = [json_util.loads(line) for line in f]
+
+    rand = random.Random(15)
+    files = [{"content_id": str(i),
+              "data": unicode(hexdump.hexdump(''.join(chr(rand.randrange(64)) for _ in range(64 * 1024)),
+                                              result='return')),
+              "encoding": "hexdump"}
+             for i in range(10)]
+    return {"status": 3, "data": analysis, "files": files}
+
+
+class TestPayloadFormats(unittest.TestCase):
+
+    def test_formats(self):
+        body = analysis_reply()
+        formats = [(content_type, content_encoding)
+                   for content_type in payload.CONTENT_TYPES
+                   for content_encoding in [payload.IDENTITY] + payload.CONTENT_ENCODINGS]
+
+        sizes = {}
+        for content_type, content_encoding in formats:
+            if content_type == payload.JSON:
+                reply = dict(body, files=json_util.dumps(body["files"]))
+            else:
+                reply = body
+
+            start = time.time()
+            for _ in range(ROUNDS):
+                data = payload.encode(reply, content_type, content_encoding)
+            encode_time = (time.time() - start) / ROUNDS
+
+            start = time.time()
+            for _ in range(ROUNDS):
+                decoded = payload.decode(data, content_type, content_encoding)
+            decode_time = (time.time() - start) / ROUNDS
+
+            self.assertEqual(len(decoded["data"]["connections"]), len(body["data"]["connections"]))
+            sizes[(content_type, content_encoding)] = len(data)
+            print "{:24} {:8} {:>9} bytes  encode {:.2f}ms  decode {:.2f}ms".format(
+                content_type, content_encoding or '-', len(data), encode_time * 1000, decode_time * 1000)
+
+        for content_type in payload.CONTENT_TYPES:
+            self.assertLess(sizes[(content_type, payload.ZLIB)], sizes[(content_type, payload.IDENTITY)])
+
+    @unittest.skipIf(payload.msgpack is None, "msgpack is not installed")
+    def test_msgpack_text(self):
+        body = {"status": 3, "data": {"url": u"http://example.com/\u00e8", "tags": ["a"]},
+                "raw": Binary("\xff\x00")}
+        decoded = payload.msgpack.unpackb(payload.encode(body, payload.MSGPACK), raw=False)
+
+        self.assertEqual(decoded, dict(body, raw="\xff\x00"))
+        self.assertTrue(all(isinstance(x, unicode) for x in decoded))
+        self.assertIsInstance(decoded["data"]["tags"][0], unicode)
+        self.assertIsInstance(decoded["raw"], str)
+
+    def test_negotiate(self):
+        self.assertEqual(payload.negotiate(None), (payload.JSON, payload.IDENTITY))
+        self.assertEqual(payload.negotiate({'accept': 'application/bson, application/json',
+                                            'accept_encoding': 'gzip,zlib'}),
+                         (payload.BSON, payload.ZLIB))
+        self.assertEqual(payload.negotiate({'accept': 'text/xml'}), (payload.JSON, payload.IDENTITY))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#
+# politeness.py
+#
+# Checks the per-domain and per-proxy limits on running scans.
+#
+
+import unittest
+
+from main.politeness import Limits, registered_domain
+
+
+class TestPoliteness(unittest.TestCase):
+
+    def test_registered_domain(self):
+        self.assertEqual(registered_domain('http://a.b.Example.co.uk:8080/x'), 'example.co.uk')
+        self.assertEqual(registered_domain('https://www.example.com/'), 'example.com')
+        self.assertEqual(registered_domain('http://192.168.1.1/'), '192.168.1.1')
+        self.assertEqual(registered_domain('www.example.com/a'), 'example.com')
+        self.assertIsNone(registered_domain('about:blank'))
+
+    def test_limits(self):
+        limits = Limits(2, 1, [('example.com', None), ('example.org', 7)])
+
+        self.assertTrue(limits.allows('example.com', None))
+        self.assertFalse(limits.allows('example.net', 7))
+        limits.add('example.com', None)
+        self.assertFalse(limits.allows('example.com', 3))
+        self.assertTrue(limits.allows(None, None))
+        self.assertEqual(limits.full_domains(), ['example.com'])
+        self.assertEqual(limits.full_proxies(), [7])
+
+    def test_no_limits(self):
+        limits = Limits(0, 0, [('example.com', 1)] * 10)
+
+        self.assertTrue(limits.allows('example.com', 1))
+        self.assertEqual(limits.full_domains(), [])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# request_throttle.py
+#
+# Checks the pausing of the consumers while all the scanner slots are busy.
+#
+
+import unittest
+
+from main.throttle import Throttle
+
+
+class Consumer(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.paused = False
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.throttle = Throttle(3)
+        self.first = Consumer("first")
+        self.second = Consumer("second")
+        self.throttle.add(self.first)
+        self.throttle.add(self.second)
+
+    def test_pause_and_resume(self):
+        self.throttle.acquire("first")
+        self.throttle.acquire("second")
+        self.assertFalse(self.throttle.full())
+        self.assertFalse(self.first.paused)
+
+        self.throttle.acquire("first")
+        self.assertTrue(self.throttle.full())
+        self.assertTrue(self.first.paused)
+        self.assertTrue(self.second.paused)
+
+        self.throttle.release("second")
+        self.assertFalse(self.throttle.full())
+        self.assertFalse(self.first.paused)
+        self.assertFalse(self.second.paused)
+
+    def test_closed_channel(self):
+        for channel in ["first", "first", "second"]:
+            self.throttle.acquire(channel)
+        self.assertTrue(self.second.paused)
+
+        # Its requests go back to the queue, the slots are free
+        self.throttle.remove(self.first)
+        self.assertFalse(self.throttle.full())
+        self.assertFalse(self.second.paused)
+
+        # Replies of requests of the closed channel are dropped
+        self.throttle.release("first")
+        self.assertEqual(self.throttle.in_flight, {"second": 1})
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# result_cache.py
+#
+# Checks which tasks are considered the same scan by the result cache.
+#
+
+import unittest
+import os
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from datetime import timedelta
+
+from bson import ObjectId
+from django.test import TestCase
+
+from main.models import Task, add_now
+from main.result_cache import find_result, normalize_url, options_hash
+from main.utils import STATUS_COMPLETED
+
+
+class Analyses(object):
+    """
+    Stands in for the analysiscombo collection, holding the given ids.
+    """
+
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def find_one(self, query, projection=None):
+        if query["_id"] in self.ids:
+            return {"_id": query["_id"]}
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url(' HTTP://Example.COM:80#top'), 'http://example.com/')
+        self.assertEqual(normalize_url('https://example.com:443/a?b=1'), 'https://example.com/a?b=1')
+        self.assertEqual(normalize_url('http://user:pw@Example.com:8080/A'), 'http://user:pw@example.com:8080/A')
+        self.assertEqual(normalize_url('example.com'), 'example.com')
+
+    def test_options_hash(self):
+        task = Task(frontend_id=1, url='http://example.com', useragent='winxpie60')
+        same = Task(frontend_id=2, url='http://EXAMPLE.com/', useragent='winxpie60', status=3)
+        other = Task(frontend_id=3, url='http://example.com', useragent='win7ie90')
+
+        self.assertEqual(options_hash(task), options_hash(same))
+        self.assertNotEqual(options_hash(task), options_hash(other))
+
+
+class TestFindResult(TestCase):
+    """
+    Needs a test database, run with manage.py test (after makemigrations).
+    """
+
+    def completed(self, frontend_id, object_id, ago, duration):
+        task = Task(frontend_id=frontend_id, url='http://example.com', status=STATUS_COMPLETED,
+                    object_id=str(object_id))
+        task.completed_on = add_now() - timedelta(seconds=ago)
+        task.started_on = task.completed_on - timedelta(seconds=duration)
+        task.options_hash = options_hash(task)
+        task.save()
+        return task
+
+    def request(self):
+        task = Task(frontend_id=99, url='http://EXAMPLE.com/')
+        task.options_hash = options_hash(task)
+        return task
+
+    def test_freshness(self):
+        fresh, stale = ObjectId(), ObjectId()
+        self.completed(1, stale, ago=100, duration=10)
+        analyses = Analyses([fresh, stale])
+
+        self.assertIsNone(find_result(self.request(), 60, analyses))
+        self.assertEqual(find_result(self.request(), 120, analyses), str(stale))
+
+        self.completed(2, fresh, ago=30, duration=10)
+        self.assertEqual(find_result(self.request(), 60, analyses), str(fresh))
+
+        # Removed from MongoDB
+        self.assertIsNone(find_result(self.request(), 60, Analyses([stale])))
+
+    def test_cache_hits_not_renewed(self):
+        scanned = ObjectId()
+        self.completed(1, scanned, ago=100, duration=10)
+        # Answered from the cache within its window
+        self.completed(2, scanned, ago=50, duration=0)
+
+        self.assertIsNone(find_result(self.request(), 60, Analyses([scanned])))
+
+    def test_no_cache(self):
+        scanned = ObjectId()
+        self.completed(1, scanned, ago=10, duration=10)
+        task = self.request()
+        task.no_cache = True
+
+        self.assertIsNone(find_result(task, 60, Analyses([scanned])))
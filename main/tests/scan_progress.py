@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# scan_progress.py
+#
+# Checks the tailing of the collections of a running analysis and the
+# notifications of its new documents.
+# You would need to run the mongo daemon to perform this test.
+#
+
+import unittest
+import pymongo
+from bson import ObjectId
+
+from main import progress
+
+TEST_DATABASE = "test_thug"
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = pymongo.MongoClient()
+        self.db = self.mongo[TEST_DATABASE]
+        self.analysis_id = ObjectId()
+
+    def tearDown(self):
+        self.mongo.drop_database(TEST_DATABASE)
+
+    def test_tail(self):
+        tail = progress.Tail(self.db, str(self.analysis_id))
+        self.assertEqual(tail.poll(), {})
+
+        first = [self.db.connections.insert({"analysis_id": self.analysis_id}) for _ in range(3)]
+        self.db.connections.insert({"analysis_id": ObjectId()})
+        self.db.codes.insert({"analysis_id": self.analysis_id})
+        self.assertEqual(tail.poll(), {"connections": first})
+        self.assertEqual(tail.poll(), {})
+
+        exploit = self.db.exploits.insert({"analysis_id": self.analysis_id})
+        connection = self.db.connections.insert({"analysis_id": self.analysis_id})
+        self.assertEqual(tail.poll(), {"exploits": [exploit], "connections": [connection]})
+
+    def test_messages(self):
+        ids = [ObjectId() for _ in range(progress.IDS_PER_MESSAGE + 1)]
+        messages = list(progress.messages(7, self.analysis_id, {"samples": ids}))
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]["frontend_id"], "7")
+        self.assertEqual(messages[0]["analysis_id"], str(self.analysis_id))
+        self.assertEqual(messages[0]["collection"], "samples")
+        self.assertEqual(messages[0]["ids"] + messages[1]["ids"], [str(x) for x in ids])
+
+    def test_subscribers(self):
+        subscribers = progress.Subscribers()
+        subscribers.add("7", "channel", "props")
+        self.assertEqual(subscribers.get("7"), ("channel", "props"))
+
+        subscribers.remove("7")
+        subscribers.remove("7")
+        self.assertIsNone(subscribers.get("7"))
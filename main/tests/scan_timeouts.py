@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# scan_timeouts.py
+#
+# Checks the time budget given to Thug runs.
+#
+
+import unittest
+import os
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from datetime import timedelta
+
+from django.test import TestCase
+
+from main.models import Task, add_now
+from main.timeouts import Durations, percentile
+from main.utils import STATUS_COMPLETED
+
+
+class FixedDurations(Durations):
+
+    def __init__(self, durations):
+        super(FixedDurations, self).__init__()
+        self.fixed = durations
+
+    def load(self):
+        return self.fixed
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertEqual(percentile([7], 0.5), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_budget_from_durations(self):
+        durations = FixedDurations({False: range(10, 110), True: range(100, 400, 3)})
+
+        self.assertEqual(durations.budget(Task(), 60, 600), 216)
+        self.assertEqual(durations.budget(Task(extensive=True), 60, 600), 600)
+        self.assertEqual(durations.budget(Task(), 300, 600), 300)
+
+    def test_budget_from_task(self):
+        durations = FixedDurations({False: range(10, 110)})
+
+        self.assertEqual(durations.budget(Task(timeout=30), 60, 600), 90)
+        self.assertEqual(durations.budget(Task(timeout=3000), 60, 600), 600)
+
+    def test_too_few_samples(self):
+        durations = FixedDurations({False: [5, 6, 7]})
+
+        self.assertEqual(durations.budget(Task(), 60, 600), 600)
+
+
+class TestDurationSamples(TestCase):
+    """
+    Needs a test database, run with manage.py test (after makemigrations).
+    """
+
+    def test_cached_results_ignored(self):
+        now = add_now()
+        Task.objects.create(frontend_id=1, url='http://example.com', status=STATUS_COMPLETED,
+                            started_on=now - timedelta(seconds=30), completed_on=now)
+        # Answered from the result cache
+        Task.objects.create(frontend_id=2, url='http://example.com', status=STATUS_COMPLETED,
+                            started_on=now, completed_on=now)
+
+        self.assertEqual(Durations().load(), {False: [30.0], True: []})
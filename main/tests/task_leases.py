@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# task_leases.py
+#
+# Checks the claiming of tasks by run_thug daemons, the renewal of the
+# leases of the tasks they run and the reclaiming of the expired ones.
+# Run with manage.py test (after makemigrations), it needs a test database.
+#
+
+import os
+import threading
+from datetime import timedelta
+
+import django
+
+# Set up django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rumal_back.settings')
+django.setup()
+
+from django.db import DatabaseError
+from django.test import TestCase
+
+from main.management.commands import run_thug
+from main.models import Task
+from main.utils import STATUS_COMPLETED, STATUS_NEW, STATUS_PROCESSING
+
+
+class TestLeases(TestCase):
+
+    def setUp(self):
+        self.command = run_thug.Command()
+
+    def claimed(self, expired=False):
+        task = Task.objects.create(frontend_id=1, url='http://example.com')
+        self.assertTrue(self.command._claim(task))
+        if expired:
+            task.lease_expires_on = self.command._now() - timedelta(seconds=1)
+            Task.objects.filter(pk=task.pk).update(lease_expires_on=task.lease_expires_on)
+        return task
+
+    def test_claim(self):
+        task = self.claimed()
+        self.assertFalse(self.command._claim(Task.objects.get(pk=task.pk)))
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.status, STATUS_PROCESSING)
+        self.assertEqual(task.owner, run_thug.OWNER_ID)
+        self.assertGreater(task.lease_expires_on, self.command._now())
+
+    def test_only_held_leases_renewed(self):
+        running = self.claimed(expired=True)
+        stuck = self.claimed(expired=True)
+
+        self.assertEqual(self.command._renew_leases([running.pk]), 1)
+        self.assertEqual(self.command._renew_leases([]), 0)
+        self.assertEqual(self.command._reclaim_expired(), 1)
+
+        self.assertEqual(Task.objects.get(pk=running.pk).status, STATUS_PROCESSING)
+        stuck = Task.objects.get(pk=stuck.pk)
+        self.assertEqual(stuck.status, STATUS_NEW)
+        self.assertIsNone(stuck.owner)
+
+    def test_release_retried(self):
+        task = self.claimed()
+        failures = [DatabaseError("database is locked")] * 2
+        store_outcome = self.command._store_outcome
+
+        def flaky(task):
+            if failures:
+                raise failures.pop()
+            return store_outcome(task)
+
+        self.command._store_outcome = flaky
+        delay, run_thug.RELEASE_RETRY_DELAY = run_thug.RELEASE_RETRY_DELAY, 0
+        try:
+            self.command._mark_as_completed(task)
+        finally:
+            run_thug.RELEASE_RETRY_DELAY = delay
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.status, STATUS_COMPLETED)
+        self.assertIsNone(task.lease_expires_on)
+
+    def test_worker_pool_held(self):
+        started = threading.Event()
+        finish = threading.Event()
+        wakeup = threading.Event()
+
+        def target(task):
+            started.set()
+            finish.wait(5)
+
+        pool = run_thug.WorkerPool(1, target, wakeup)
+        pool.submit(Task(pk=7))
+        self.assertTrue(started.wait(5))
+        self.assertEqual(pool.held(), [7])
+
+        finish.set()
+        self.assertTrue(wakeup.wait(5))
+        self.assertEqual(pool.held(), [])
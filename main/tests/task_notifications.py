@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#
+# task_notifications.py
+#
+# Checks the routing of the task notifications to their callbacks.
+#
+
+import threading
+import unittest
+
+from main.notify import Dispatcher
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_all_callbacks_called_once(self):
+        dispatcher = Dispatcher("frontend_id")
+        called = []
+        done = threading.Semaphore(0)
+
+        def callback(name):
+            called.append(name)
+            done.release()
+
+        dispatcher.register("7", lambda: callback("first"))
+        dispatcher.register("7", lambda: callback("again"))
+        self.assertEqual(dispatcher.pending(), ["7"])
+
+        dispatcher({"frontend_id": "7"})
+        done.acquire()
+        done.acquire()
+        self.assertEqual(sorted(called), ["again", "first"])
+        self.assertEqual(dispatcher.pending(), [])
+        self.assertFalse(dispatcher.fire("7"))
+
+    def test_failing_callback(self):
+        dispatcher = Dispatcher("frontend_id")
+        done = threading.Event()
+
+        def fail():
+            raise ValueError("broken")
+
+        dispatcher.register("7", fail)
+        dispatcher.register("7", done.set)
+        self.assertTrue(dispatcher.fire("7"))
+        self.assertTrue(done.wait(5))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#
+# task_scheduler.py
+#
+# Checks that the task scheduler honours priorities and shares workers
+# fairly between queues and users.
+#
+
+import unittest
+
+from main.scheduler import schedule
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_priority_first(self):
+        waiting = [(0, 1, 'any_queue', 100, 1), (5, 2, 'any_queue', 2, 2)]
+
+        self.assertEqual(schedule(waiting, {}, 4),
+                         {(5, 2, 'any_queue'): 2, (0, 1, 'any_queue'): 2})
+
+    def test_users_share(self):
+        # User 1 bulk-submitted long before user 2 sent a single scan
+        waiting = [(0, 1, 'any_queue', 5000, 1), (0, 2, 'any_queue', 1, 2)]
+
+        self.assertEqual(schedule(waiting, {(1, 'any_queue'): 3}, 1),
+                         {(0, 2, 'any_queue'): 1})
+        self.assertEqual(schedule(waiting, {}, 4),
+                         {(0, 1, 'any_queue'): 3, (0, 2, 'any_queue'): 1})
+
+    def test_queue_weights(self):
+        waiting = [(0, 1, 'any_queue', 100, 1), (0, 1, 'private_queue', 100, 2)]
+
+        self.assertEqual(schedule(waiting, {}, 6, {'private_queue': 2}),
+                         {(0, 1, 'any_queue'): 2, (0, 1, 'private_queue'): 4})
+
+    def test_fewer_tasks_than_slots(self):
+        waiting = [(0, None, None, 1, 1)]
+
+        self.assertEqual(schedule(waiting, {}, 4), {(0, None, None): 1})
+        self.assertEqual(schedule([], {}, 4), {})
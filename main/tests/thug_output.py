@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# thug_output.py
+#
+# Checks that the output of Thug runs is parsed while it is read and
+# spooled to disk within its size cap.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from main.thug_output import ThugOutput, prune
+
+OUTPUT = (
+    "[2016-01-20 10:00:00] [window open redirection] about:blank -> http://example.com\n"
+    "[2016-01-20 10:00:01] [MongoDB] Analysis ID: 569f5b1a2f4e2c0001a1b2c3\n"
+    "[2016-01-20 10:00:01] Thug analysis logs saved at ../logs\n"
+)
+
+
+class TestThugOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "thug", "1.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_analysis_id(self):
+        output = ThugOutput(self.path, 1024)
+        output.read(StringIO(OUTPUT))
+
+        self.assertEqual(output.analysis_id, "569f5b1a2f4e2c0001a1b2c3")
+        self.assertIsNotNone(output.first_line_at)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), OUTPUT)
+
+        output.discard()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_size_cap(self):
+        output = ThugOutput(self.path, 100)
+        output.read(StringIO("x" * 80 + "\n" + "y" * 200000 + "\n" + OUTPUT))
+
+        self.assertEqual(output.analysis_id, "569f5b1a2f4e2c0001a1b2c3")
+        self.assertTrue(output.truncated)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "x" * 80 + "\n[Output truncated at 100 bytes]\n")
+
+    def test_no_analysis_id(self):
+        output = ThugOutput(self.path, 1024)
+        output.read(StringIO(""))
+
+        self.assertIsNone(output.analysis_id)
+        self.assertIsNone(output.first_line_at)
+
+    def test_prune(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory)
+        for name, age, size in [("old.log", 3000, 10), ("big.log", 200, 100), ("new.log", 100, 60)]:
+            path = os.path.join(directory, name)
+            with open(path, "wb") as f:
+                f.write("x" * size)
+            os.utime(path, (1000000 - age, 1000000 - age))
+
+        self.assertEqual(prune(directory, 0, 0, now=1000000), 0)
+        self.assertEqual(prune(directory, 1000, 0, now=1000000), 1)
+        self.assertEqual(sorted(os.listdir(directory)), ["big.log", "new.log"])
+        self.assertEqual(prune(directory, 1000, 100, now=1000000), 1)
+        self.assertEqual(os.listdir(directory), ["new.log"])
+        self.assertEqual(prune(os.path.join(self.directory, "missing"), 1, 1), 0)
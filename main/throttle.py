@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# throttle.py
+#
+# Flow control of the consumer. Scan requests are acked when their reply
+# is sent, so the ones in flight are counted against the scanner worker
+# slots and consuming pauses while none is free.
+
+import logging
+import threading
+
+from main.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class Throttle(object):
+    """
+    Counts the scan requests in flight on every channel and pauses all the
+    consumers while they take up all the scanner worker slots, so requests
+    stay in the queue for other backends.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.in_flight = {}
+        self.consumers = []
+        self.lock = threading.Lock()
+
+    def full(self):
+        with self.lock:
+            return sum(self.in_flight.values()) >= self.slots
+
+    def add(self, consumer):
+        with self.lock:
+            self.consumers.append(consumer)
+
+    def remove(self, consumer):
+        with self.lock:
+            if consumer in self.consumers:
+                self.consumers.remove(consumer)
+            count = sum(self.in_flight.values())
+            # Unacked messages of a closed channel go back to the queue
+            lost = self.in_flight.pop(consumer.channel, 0)
+        self._update(count, count - lost)
+
+    def acquire(self, channel):
+        with self.lock:
+            count = sum(self.in_flight.values())
+            self.in_flight[channel] = self.in_flight.get(channel, 0) + 1
+        self._update(count, count + 1)
+
+    def release(self, channel):
+        with self.lock:
+            if not self.in_flight.get(channel):
+                # Its channel was closed, the slot is free already
+                return
+            count = sum(self.in_flight.values())
+            self.in_flight[channel] -= 1
+        self._update(count, count - 1)
+
+    def _update(self, before, after):
+        registry.set('rumal_requests_in_flight', after)
+        with self.lock:
+            consumers = list(self.consumers)
+        if before < self.slots <= after:
+            logger.debug("All {} scanner slots busy, pausing consumers".format(self.slots))
+            for consumer in consumers:
+                consumer.pause()
+        elif after < self.slots <= before:
+            logger.debug("Scanner slot available, resuming consumers")
+            for consumer in consumers:
+                consumer.resume()
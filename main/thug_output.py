@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# thug_output.py
+#
+# Output of a Thug run. It is read line by line while Thug runs, so the
+# analysis id is known as soon as Thug prints it, and spooled to a file
+# up to a size cap rather than held in memory: verbose and debug scans
+# print a lot.
+
+import errno
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_ID = re.compile(r'\[MongoDB\] Analysis ID: ([a-z0-9]+)\b')
+
+# Longest line read at once, longer ones are read in pieces
+MAX_LINE = 64 * 1024
+
+
+class ThugOutput(object):
+    """
+    Spools the output of a Thug run to path, keeping at most cap bytes of it.
+    """
+
+    def __init__(self, path, cap):
+        self.path = path
+        self.cap = cap
+        self.size = 0
+        self.truncated = False
+        self.analysis_id = None
+        self.first_line_at = None
+
+    def read(self, stream):
+        """
+        Reads stream until EOF, i.e. until Thug exits or is killed.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # Created meanwhile by the scan of another worker
+                if e.errno != errno.EEXIST:
+                    raise
+
+        with open(self.path, "wb") as spool:
+            for line in iter(lambda: stream.readline(MAX_LINE), b''):
+                self.feed(line, spool)
+
+    def feed(self, line, spool):
+        if self.first_line_at is None:
+            self.first_line_at = time.time()
+
+        if self.analysis_id is None:
+            r = ANALYSIS_ID.search(line)
+            if r:
+                self.analysis_id = r.group(1)
+
+        if self.size + len(line) <= self.cap:
+            spool.write(line)
+            self.size += len(line)
+        elif not self.truncated:
+            spool.write(b"[Output truncated at {} bytes]\n".format(self.cap))
+            self.truncated = True
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logger.debug("Unable to remove {}: {}".format(self.path, e))
+
+
+def prune(directory, max_age, total_cap, now=None):
+    """
+    Removes the outputs kept in directory for failed tasks that are older
+    than max_age seconds, then the oldest ones until all of them take at
+    most total_cap bytes. A limit of 0 disables it. Returns how many files
+    were removed.
+    """
+    now = now or time.time()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+
+    files = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    files.sort(reverse=True)  # newest first
+
+    removed = 0
+    total = 0
+    for mtime, size, path in files:
+        total += size
+        if (max_age and now - mtime > max_age) or (total_cap and total > total_cap):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.debug("Unable to remove {}: {}".format(path, e))
+    return removed
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# timeouts.py
+#
+# Time budget of each Thug run. A single fixed timeout lets a hung
+# container hold a worker for as long as the slowest legitimate scan may
+# take. The budget is derived instead from the task's own analysis timeout
+# or, lacking one, from the durations of the recent scans with the same
+# extensive setting, always within [thug] min_timeout and timeout.
+
+import logging
+import math
+import threading
+import time
+
+from django.db.models import F
+
+from main.metrics import registry
+from main.models import Task
+from main.utils import STATUS_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+# Seconds on top of the analysis timeout asked by a task, for the container
+# to start and Thug to store its results
+MARGIN = 60
+
+# Recent scans the percentiles are computed on, and the fewest trusted
+SAMPLES = 500
+MIN_SAMPLES = 20
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+def percentile(values, p):
+    """
+    Returns the p-th (0 to 1) percentile of sorted values, by nearest rank.
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(math.ceil(p * len(values))) - 1))
+    return values[rank]
+
+
+class Durations(object):
+    """
+    Durations of the recent completed scans, grouped by their extensive
+    option and reloaded from the Task table every refresh seconds.
+    """
+
+    def __init__(self, refresh=5 * 60):
+        self.refresh = refresh
+        self.loaded_on = None
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        durations = {}
+        for extensive in [False, True]:
+            # Tasks answered from the result cache start and complete at
+            # once, they are not scans
+            tasks = Task.objects.filter(
+                status__exact=STATUS_COMPLETED,
+                extensive=extensive,
+                started_on__isnull=False,
+                completed_on__gt=F('started_on')
+            ).order_by('-completed_on').values_list('started_on', 'completed_on')[:SAMPLES]
+            durations[extensive] = sorted(
+                (completed_on - started_on).total_seconds() for started_on, completed_on in tasks)
+
+            # The distribution, for tuning the timeouts
+            for q in QUANTILES:
+                value = percentile(durations[extensive], q)
+                if value is not None:
+                    registry.set('rumal_scan_duration_seconds', value,
+                                 quantile=q, extensive=extensive)
+        return durations
+
+    def get(self, extensive):
+        with self.lock:
+            if self.loaded_on is None or time.time() - self.loaded_on > self.refresh:
+                try:
+                    self.durations = self.load()
+                except Exception as e:
+                    logger.exception("Unable to load scan durations: {}".format(e))
+                self.loaded_on = time.time()
+            return self.durations.get(bool(extensive), [])
+
+    def budget(self, task, minimum, maximum, p=0.99, factor=2.0):
+        """
+        Returns the seconds task may run for.
+        """
+        if task.timeout:
+            budget = task.timeout + MARGIN
+        else:
+            durations = self.get(task.extensive)
+            if len(durations) < MIN_SAMPLES:
+                return maximum
+            budget = percentile(durations, p) * factor
+        return int(max(minimum, min(maximum, budget)))
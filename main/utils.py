@@ -30,6 +30,15 @@ STATUS_COMPLETED = 3
 
 #  tasks
 NEW_SCAN_TASK = 1
+FETCH_FILES_TASK = 2
+BULK_SCAN_TASK = 3
+
+# file transfer modes
+FILE_TRANSFER_INLINE = 'inline'
+FILE_TRANSFER_STREAM = 'stream'
+FILE_CHUNK = 'file_chunk'  # type of the messages carrying streamed files
+BULK_ITEM = 'bulk_item'  # type of the replies to each scan of a bulk task
+PROGRESS = 'progress'  # type of the messages with partial results of a scan
 
 # Rabbit settings
 RPC_PORT = 5672
@@ -37,6 +46,19 @@ ANY_QUEUE = 'any_queue'
 PRIVATE_QUEUE = 'private_queue'
 PRIVATE_HOST = '0.0.0.0'
 
+# Local notifications between consumer and run_thug
+NOTIFY_HOST = '127.0.0.1'
+NEW_TASK_PORT = 5680
+TASK_DONE_PORT = 5681
+PROGRESS_PORT = 5682
+
+# Thug collections merged into the analysis by club_collections
+CHILD_COLLECTIONS = [
+    "exploits", "codes", "behaviors", "certificates", "maec11", "pcaps",
+    "connections", "samples", "locations", "virustotal", "honeyagent",
+    "androguard", "peepdf",
+]
+
 
 class DownloadError(Exception):
     pass
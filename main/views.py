@@ -1,3 +1,18 @@
-from django.shortcuts import render
+from django.db.models import Count
+from django.http import HttpResponse
 
-# Create your views here.
+from main import metrics
+from main.models import STATUS_CHOICES, Task
+
+
+def metrics_view(request):
+    """
+    Metrics of all the backend daemons running on this host, plus the
+    number of tasks by status, in the Prometheus text format.
+    """
+    counts = dict(Task.objects.values_list('status').annotate(Count('id')))
+    tasks = [('rumal_tasks', {'status': label.lower()}, counts.get(status, 0))
+             for status, label in STATUS_CHOICES]
+
+    return HttpResponse(metrics.render(metrics.load_snapshots(), tasks),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
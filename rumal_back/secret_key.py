@@ -0,0 +1 @@
+SECRET_KEY = "%4xt*t+^2$yjoq3o*vixn-6)23-ep9vq6m@kuan35z(&c*8s2k"
\ No newline at end of file
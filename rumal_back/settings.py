@@ -98,6 +98,9 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Snapshots of the daemons metrics, served by the metrics view
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
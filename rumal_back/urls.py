@@ -1,6 +1,9 @@
 from django.conf.urls import include, url
 from django.contrib import admin
 
+from main.views import metrics_view
+
 urlpatterns = [
-    url(r'^admin/', include(admin.site.urls))
+    url(r'^admin/', include(admin.site.urls)),
+    url(r'^metrics$', metrics_view, name='metrics'),
 ]